@@ -0,0 +1,33 @@
+""" times parsing a certificate and reading its expiry, start, issuer, serial and organisation with ssl_cert.Certificate,
+over the certificates in the system ca bundle (or the pem file given). run from this directory:
+python3 bench_certificate.py [--der] [pem file]. certificates are given as pem strings unless --der is set, so the
+same command can be run on older versions of ssl_cert that only took pem """
+import re
+import ssl
+import sys
+import time
+import warnings
+import ssl_cert
+
+
+def read_certificates(path):
+    with open(path) as f:
+        return re.findall("-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----\n", f.read(), re.DOTALL)
+
+
+def bench(certificates, count=5000):
+    started = time.perf_counter()
+    for index in range(count):
+        certificate = ssl_cert.Certificate(certificates[index % len(certificates)], **ssl_cert.ALL_OPTIONS)
+        [certificate.expiry, certificate.start, certificate.issuer, certificate.serial, certificate.subject_org]
+    return (time.perf_counter() - started) / count
+
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")  # some ca certificates have serial numbers cryptography warns about
+    der = "--der" in sys.argv
+    paths = [arg for arg in sys.argv[1:] if arg != "--der"]
+    pems = read_certificates(paths[0] if paths else ssl.get_default_verify_paths().cafile)
+    certificates = [ssl.PEM_cert_to_DER_cert(pem) for pem in pems] if der else pems
+    print("{0} certificates as {1}: {2:.1f}us per certificate".format(len(certificates), "der" if der else "pem",
+                                                                     bench(certificates) * 1e6))
@@ -0,0 +1,34 @@
+""" times sorting and categorising a run's sites with SiteBatch against the dictionary implementation it replaced, on
+the random sites of test_site_batch. run from this directory: python3 bench_site_batch.py [number of sites ...] """
+import copy
+import sys
+import time
+import conversions
+import test_site_batch
+from site_batch import SiteBatch
+
+
+def bench(count):
+    sites = test_site_batch.random_sites(0, count)
+    old_sites = [test_site_batch.without_nan_dates(site) for site in copy.deepcopy(sites)]
+
+    started = time.perf_counter()
+    expected = test_site_batch.old_sorted_categories(old_sites)
+    old_time = time.perf_counter() - started
+
+    batch = SiteBatch.from_sites(sites)
+    started = time.perf_counter()
+    batch.categorise(test_site_batch.NOW)
+    categorise_time = time.perf_counter() - started
+    categorised = batch.categories()
+    categories_time = time.perf_counter() - started
+
+    equal = all([dict(site) for site in categorised[category]] == expected[category] for category in expected)
+    print("{0} sites: equal {1}, dictionaries {2:.3f}s, SiteBatch categorise {3:.3f}s ({4:.3f}s with the category "
+          "dictionary of views)".format(count, equal, old_time, categorise_time, categories_time))
+
+
+if __name__ == "__main__":
+    conversions.datetime = test_site_batch.FixedDatetime  # the old categorise_sites takes the time itself
+    for count in [int(arg) for arg in sys.argv[1:]] or [1000, 100000]:
+        bench(count)
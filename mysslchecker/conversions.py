@@ -2,32 +2,16 @@ from datetime import datetime
 from dateutil import relativedelta
 import re
 import pytz
+import numpy as np
+from site_batch import SiteBatch
 
 
 def get_sorted_categories(site_list):
-    """ wrap up the sorting and categories into a single method """
-
-    valid_sites = []  # list sites that don't have an error key
-    invalid_sites = []  # list sites that do have an error key
-    no_ssl_sites = []
-
-    for site in site_list:
-        if "expiry" not in site:
-            site["ssl_status"] = "missing"
-            no_ssl_sites.append(site)
-        elif "error" in site and "PASS" not in site["error"]:  # fail if it doesn't include pass
-            site["ssl_status"] = "fail"
-            invalid_sites.append(site)
-        else:
-            site["ssl_status"] = "pass"  # pass if it does include pass or has no errors
-            valid_sites.append(site)
-
-    sorted_valid_list = sort_sites(valid_sites, "expiry")
-    sorted_invalid_list = sort_sites(invalid_sites, "url")  # if sites are invalid, sort them alphabetically
-    sorted_no_ssl_list = sort_sites(no_ssl_sites, "url")
-    categorised_list = categorise_sites(sorted_no_ssl_list + sorted_invalid_list + sorted_valid_list)  # add the three lists together and categorise
-
-    return categorised_list
+    """ wrap up the sorting and categories into a single method. returns a dictionary of category: site list, where
+    each site is a read only site_batch.SiteView with its "ssl_status" """
+    batch = SiteBatch.from_sites(site_list)
+    batch.categorise()
+    return batch.categories()
 
 
 def sort_sites(site_list, key):
@@ -179,3 +163,29 @@ def to_london_time(python_dt):
     """return london timezone from python date object"""
     ldn_time = python_dt.astimezone(pytz.timezone("Europe/London"))
     return ldn_time
+
+
+def transition_table(zone):
+    """ the (utc epoch of each change, utc offset in seconds from then) arrays of a pytz timezone, or None if the
+    timezone does not have them. _utc_transition_times and _transition_info are private to pytz's DstTzInfo
+    (https://pypi.org/project/pytz/), so a pytz release could drop them """
+    if not hasattr(zone, "_utc_transition_times") or not hasattr(zone, "_transition_info"):
+        return None
+    transitions = np.array([(when - datetime(1970, 1, 1)).total_seconds() for when in zone._utc_transition_times[1:]])
+    offsets = np.array([offset.total_seconds() for offset, dst, name in zone._transition_info])
+    return transitions, offsets
+
+
+def london_offsets(timestamps):
+    """ the utc offset in seconds of london time at each of an array of timestamps. looks the timestamps up in the
+    pytz transition table (the changes to and from BST) in one pass rather than converting each date. without the
+    table each date is converted on its own as google_time() does. the offset of a missing (nan) date is 0 """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    table = transition_table(pytz.timezone("Europe/London"))
+    if table is None:
+        offsets = np.zeros(timestamps.shape)
+        for index in np.flatnonzero(np.isfinite(timestamps)):
+            offsets[index] = to_london_time(datetime.fromtimestamp(timestamps[index])).utcoffset().total_seconds()
+        return offsets
+    transitions, offsets = table
+    return np.where(np.isfinite(timestamps), offsets[np.searchsorted(transitions, timestamps, side="right")], 0.0)
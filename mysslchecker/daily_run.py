@@ -60,7 +60,8 @@ def daily_run(mgmt_sheet_id, mgmt_tab_name="Users"):
 
                 print("starting: ", sheet_id, " ", mgmt_sheet_id)
                 ssl_checker.ssl_checker(sheet_id, dashboard_tab=dashboard_tab, email_tab=email_tab, domains_tab=website_tab,
-                                        mgmt_sheet_id=mgmt_sheet_id, mgmt_tab_name=mgmt_tab_name, timeout=10, forgiving=row_forgive)
+                                        mgmt_sheet_id=mgmt_sheet_id, mgmt_tab_name=mgmt_tab_name, timeout=10, forgiving=row_forgive,
+                                        scheduled=True, interactive=False)  # only probe the domains that are due
 
                 time.sleep(10)
                 print("finished: ", sheet_id, " ", mgmt_sheet_id)
@@ -1,21 +1,36 @@
-import subprocess
 from email_ssl_alert import SendEmail
 import re
 from googleapiclient.errors import HttpError
-import conversions
 import time
 import queue
-import json
+import ssl_cert
+from probe_engine import ProbeEngine
+from probe_limits import DestinationLimits, DestinationQueue
+from probe_pool import ProbePool
+from ssl_contexts import registry
+from resolver import Resolver
+from probe_schedule import ProbeSchedule
+from probe_cache import ProbeCache
+from probe_backoff import ProbeBackoff
+import redirects
+from latency import LatencyHistory
+from site_batch import SiteBatch
+import os
 from rq import Queue
 from worker import conn
 import threading
 
+# the countdown is not taken at probe time - it is worked out from the expiry when the results are written out
+SITE_FIELDS = tuple(field for field in ssl_cert.ALL_FIELDS if field != "countdown")
+
 
 class RunSSL:
 
-    def __init__(self, domain_list, forgiving, timeout, mySheet, manage_sheet_object, recipients, start_time):
+    def __init__(self, domain_list, forgiving, timeout, mySheet, manage_sheet_object, recipients, start_time,
+                 scheduled=False, interactive=True):
         self.domain_list = domain_list
         self.sorted_site_list = None
+        self.site_batch = None  # site_batch.SiteBatch of the sorted sites
         self.mySheet = mySheet
         self.manage_sheet_object = manage_sheet_object
         self.recipients = recipients
@@ -23,11 +38,235 @@ class RunSSL:
         self.timeout = timeout
         self.email_thread_list = None
         self.thread_max = 30
+        self.probe_engine = os.getenv("SSL_PROBE_ENGINE", "async")  # "async" or "threads"
+        self.probe_concurrency = int(os.getenv("SSL_PROBE_CONCURRENCY", 500))  # max concurrent handshakes for the async engine
+        self.probe_min_concurrency = int(os.getenv("SSL_PROBE_MIN_CONCURRENCY", 0))  # if set, the async engine adapts its concurrency between this and the max (see probe_limits.AIMDLimiter)
+        self.probe_capture = os.getenv("SSL_PROBE_MODE", "capture") == "capture"  # "capture" (one handshake, offline verification) or "retry"
+        self.probe_all_addresses = os.getenv("SSL_PROBE_ALL_ADDRESSES", "false") == "true"  # probe every resolved IP of a domain and flag certificates that differ
+        self.probe_per_address = int(os.getenv("SSL_PROBE_MAX_PER_ADDRESS", 8))  # max concurrent handshakes to one ip address, 0 for no limit
+        self.probe_per_domain = int(os.getenv("SSL_PROBE_MAX_PER_DOMAIN", 16))  # max concurrent handshakes to one registrable domain, 0 for no limit
+        self.probe_hedge = os.getenv("SSL_PROBE_HEDGE", "false") == "true"  # retry handshakes slower than the run's p95 in parallel (async engine only)
+        self.probe_hedge_budget = float(os.getenv("SSL_PROBE_HEDGE_BUDGET", 5)) / 100  # max extra handshakes from hedging, as a percentage
         self.start_time = start_time
+        self.interactive = interactive  # started from the form rather than the daily run
+        weight = "SSL_PROBE_WEIGHT_INTERACTIVE" if interactive else "SSL_PROBE_WEIGHT_SCHEDULED"
+        self.probe_weight = int(os.getenv(weight, 4 if interactive else 1))  # share of the probe pool across every process (see probe_pool.ProbePool)
+        self.request_budget = None  # seconds from start_time a web request has to finish in, None in the background
+        self.scheduled = scheduled  # only probe domains that are due (see probe_schedule.ProbeSchedule), reuse stored results for the rest
 
     def elapsed_time(self):
         return time.time() - self.start_time
 
+    def probe_workers(self):
+        """ the number of sites that can be probed at the same time by the selected probe engine """
+        return self.probe_concurrency if self.probe_engine == "async" else self.thread_max
+
+    @staticmethod
+    def get_site_target(site_row):
+        """ returns a (url, port) tuple for a row of the domains tab, or None if the row is not a valid domain.
+        port is None if not provided """
+        url = site_row[0]  # return the first cell per row
+        if url.startswith(("https://", "http://")):
+            url = url[url.find("//")+2:]  # urls cannot be regex'ed so need to remove protocol from string
+
+        domain_pattern = r"(?i)\b([a-z0-9]+(-[a-z0-9]+)*\.)+[a-z]{2,}\b"
+        domain = re.match(domain_pattern, url)  # return only the domain (strip the protocol or any sub '/' pages)
+
+        if domain:
+            url = domain.group(0)  # return the matched string
+            port = int(site_row[1]) if site_row[1] else None  # if there's a second value, use it as the port
+            return url, port
+        else:
+            print("'{0}' is not a valid domain - ignored".format(url))
+            return None
+
+    @staticmethod
+    def site_url(url, port):
+        """ the url shown for a site in the dashboard and emails """
+        if port and (not port == 443):
+            return "http://{0}:{1}".format(url, port)
+        else:
+            return "https://{0}".format(url)
+
+    @classmethod
+    def create_site(cls, result, url, port):
+        """ converts a ssl_cert.ProbeResult into the site object used by the rest of the app """
+        site = result.to_dict(SITE_FIELDS)
+        site["checked"] = time.time()  # when the certificate was probed (cached results keep the original time)
+        if result.fingerprint:
+            site["fingerprint"] = result.fingerprint  # groups the sites that share a certificate
+        site["url"] = cls.site_url(url, port)  # add url to site object
+        print(site["url"])
+        return site
+
+    @staticmethod
+    def print_probe_stats(results, resolver):
+        """ log where the probe time went - dns resolution is reported separately from the tls handshakes """
+        tls_times = [result.timings["tls"] for result in results if "tls" in result.timings]
+        print("dns resolution: {0}".format(resolver.stats))
+        if tls_times:
+            print("tls probes: {0} in {1:.2f}s total, mean {2:.3f}s, max {3:.3f}s".format(
+                len(tls_times), sum(tls_times), sum(tls_times) / len(tls_times), max(tls_times)))
+        families = {}  # the address family that won each connection (happy eyeballs)
+        for result in results:
+            if result.peer:
+                families[result.peer["family"]] = families.get(result.peer["family"], 0) + 1
+        print("connected address families: {0}".format(families))
+        divergent = [result.hostname for result in results if result.divergent]
+        if divergent:
+            print("certificates differ between addresses for: {0}".format(divergent))
+        unreachable = {result.hostname: result.unreachable for result in results if result.unreachable}
+        if unreachable:
+            print("addresses that gave no certificate (not counted as a failure): {0}".format(unreachable))
+        print("ssl context registry: {0}".format(registry.get_stats()))
+        print("certificate cache: {0}".format(ssl_cert.certificates.stats))
+
+    def probe_targets(self, targets, forgiving, timeout, resolver, timeouts=None, durations=None, baselines=None,
+                      probe_cache=None):
+        """ probes the (url, port) targets with the selected probe engine. returns a tuple of the ssl_cert.ProbeResult
+        list and a ((url, port), site) list. timeouts is an optional dictionary of (url, port): timeout for targets
+        that should not use the run timeout.
+        durations is an optional dictionary of (url, port): expected seconds. the targets expected to take longest are
+        started first (longest processing time first) so slow hosts do not hold up the end of the run.
+        baselines is an optional dictionary of (url, port): usual connect and handshake seconds, which the adaptive
+        concurrency limit of the async engine compares each probe with.
+        probe_cache is an optional probe_cache.ProbeCache that keeps each host's certificate, so that the re-probe of a
+        forgiving mode redirect to a domain probed recently is answered from the cache """
+        timeouts = timeouts if timeouts else {}
+        baselines = baselines if baselines else {}
+        probed_sites = []
+        if not targets:
+            return [], probed_sites
+        if durations:
+            targets = sorted(targets, key=lambda target: durations.get(target, 0), reverse=True)
+        started = time.time()
+        destinations = DestinationLimits(self.probe_per_address, self.probe_per_domain)
+
+        share = ProbePool(conn).join(self.mySheet.spreadsheet_id, self.probe_weight)
+
+        with share:
+            if self.probe_engine == "async":
+                engine_timeouts = {(url, port or 443): target_timeout for (url, port), target_timeout in timeouts.items()}
+                engine_baselines = {(url, port or 443): baseline for (url, port), baseline in baselines.items()}
+                engine = ProbeEngine(timeout=int(timeout), forgiving=forgiving, concurrency=self.probe_concurrency,
+                                     capture=self.probe_capture, resolver=resolver,
+                                     all_addresses=self.probe_all_addresses, timeouts=engine_timeouts,
+                                     hedge=self.probe_hedge, hedge_budget=self.probe_hedge_budget,
+                                     cert_options=ssl_cert.ALL_OPTIONS, min_concurrency=self.probe_min_concurrency,
+                                     destinations=destinations, baselines=engine_baselines, share=share,
+                                     probe_cache=probe_cache)
+                results = engine.run([(url, port or 443) for url, port in targets])
+                if self.probe_hedge:
+                    print("hedged handshakes: {0}".format(engine.hedge_stats))
+                if engine.min_concurrency:
+                    print("probe concurrency: {0}".format(engine.limiter.stats))
+                for (url, port), result in zip(targets, results):
+                    probed_sites.append(((url, port), self.create_site(result, url, port)))
+            else:
+                addresses = resolver.run([url for url, port in targets])
+                results = []
+
+                def probe_target(url, port):
+                    """ probes the certificate for a (url, port) target """
+                    target_timeout = timeouts.get((url, port), int(timeout))
+                    if self.probe_all_addresses:
+                        result = ssl_cert.probe_each_address(url, port or 443, target_timeout, forgiving,
+                                                             self.probe_capture, addresses.get(url),
+                                                             probe_cache=probe_cache, **ssl_cert.ALL_OPTIONS)
+                    else:
+                        result = ssl_cert.probe(url, port or 443, target_timeout, forgiving, self.probe_capture,
+                                                addresses.get(url), probe_cache=probe_cache, **ssl_cert.ALL_OPTIONS)
+                    result.timings["resolve"] = resolver.lookup_times.get(url, 0.0)
+                    return result
+
+                def run_ssl_cert(site_queue: DestinationQueue, worker):
+                    """ probes the certificate for each domain in the queue and stores the result. workers numbered
+                    above the run's share of the probe pool wait until the share grows """
+
+                    while True:
+                        while worker >= share.limit and len(site_queue):
+                            time.sleep(0.1)
+                        target = site_queue.get()
+                        if target is None:
+                            break
+                        share.started(queued_at)
+                        url, port = target
+                        result = probe_target(url, port)
+                        results.append(result)
+                        probed_sites.append(((url, port), self.create_site(result, url, port)))
+                        site_queue.done(target)
+                    return
+
+                def target_keys(target):
+                    url_addresses = addresses.get(target[0]) or []
+                    if not self.probe_all_addresses:
+                        url_addresses = ssl_cert.first_address(url_addresses)
+                    return destinations.keys(target[0], url_addresses)
+
+                q = DestinationQueue(targets, destinations, target_keys)
+                share.enqueue(len(targets))
+                queued_at = time.time()
+
+                thread_list = []
+
+                thread_no = 1
+                if 1 <= len(targets) <= self.thread_max:
+                    thread_no = len(targets)
+                elif self.thread_max <= len(targets):
+                    thread_no = self.thread_max
+
+                for i in range(thread_no):
+                    t = threading.Thread(target=run_ssl_cert, args=(q, i), name="thread {}".format(i))
+                    thread_list.append(t)
+                    t.setDaemon(True)
+                    t.start()
+                    # print("thread started: ", t.name)
+
+                for t in thread_list:
+                    t.join()
+
+        print("probe pool share: {0}".format({name: value for name, value in share.stats.items() if name != "tenants"}))
+        for tenant, tenant_stats in sorted(share.stats["tenants"].items()):
+            print("probe pool tenant {0}: {1}".format(tenant, tenant_stats))
+        if destinations.stats["waited"]:
+            print("probes held back by the per destination limits: {0}".format(destinations.stats))
+        self.print_makespan(time.time() - started, results)
+        return results, probed_sites
+
+    def print_makespan(self, makespan, results):
+        """ log how long the probes took compared with the shortest possible time for the same probe durations on the
+        number of probe workers - the longest single probe, or the total split evenly across the workers """
+        durations = [result.timings.get("tls", 0.0) for result in results]
+        if not durations or not makespan:
+            return
+        lower_bound = max(max(durations), sum(durations) / min(self.probe_workers(), len(durations)))
+        print("probe makespan: {0:.2f}s, lower bound {1:.2f}s ({2:.0%} of optimal)".format(
+            makespan, lower_bound, lower_bound / makespan))
+
+    def longest_timeout(self, timeout, timeouts=None):
+        """ the longest handshake timeout a host is given in the run - the largest of the per host timeouts if they have
+        been worked out, else the most a host could be given. interactive runs cap every host at the run timeout so the
+        web request can finish in time (see LatencyHistory.get_timeouts) """
+        if timeouts is not None:
+            return max([int(timeout)] + list(timeouts.values()))
+        return int(timeout) if self.interactive else max(int(timeout), LatencyHistory(conn).ceiling)
+
+    def lock_timeout(self, durations, timeouts, timeout, forgiving):
+        """ seconds to hold the probe cache locks for. they are all taken before probing starts, so they must last the
+        whole run - at most the expected probe time shared across the workers plus the longest probe, taken at its
+        deadline """
+        deadline = ProbeEngine.default_deadline(self.longest_timeout(timeout, timeouts), forgiving)
+        return int(sum(durations.values()) / self.probe_workers() + deadline) + 10
+
+    def wait_budget(self, timeouts, timeout, forgiving):
+        """ seconds this run can wait for domains being probed by other runs. a run inside a web request must leave
+        time to probe the domains itself if the other run does not finish, before request_budget runs out. None if
+        the run has no budget (e.g. it is running in the background) """
+        if self.request_budget is None:
+            return None
+        deadline = ProbeEngine.default_deadline(self.longest_timeout(timeout, timeouts), forgiving)
+        return max(0, self.request_budget - self.elapsed_time() - deadline)
+
     def run_site_results(self, domain_list=None, forgiving=None, timeout=None):
         domain_list = self.domain_list if not domain_list else domain_list
         forgiving = self.forgiving if not forgiving else forgiving
@@ -36,102 +275,91 @@ class RunSSL:
         print("in the function")
         site_list = []  # list of site objects
 
-        def run_ssl_cert(site_queue: queue.Queue):
-            """ calls the ssl_cert script and returns the result for each domain """
-
-            arg_string = "--all "
-            if forgiving:
-                arg_string += "--forgiving "
-            if timeout:
-                arg_string += "--timeout {0}".format(timeout)
-
-            while not site_queue.empty():
-
-                site_row = site_queue.get()
-
-                url = site_row[0]  # return the first cell per row
-                if url.startswith(("https://", "http://")):
-                    url = url[url.find("//")+2:]  # urls cannot be regex'ed so need to remove protocol from string
-
-                domain_pattern = r"(?i)\b([a-z0-9]+(-[a-z0-9]+)*\.)+[a-z]{2,}\b"
-                domain = re.match(domain_pattern, url)  # return only the domain (strip the protocol or any sub '/' pages)
-
-                if domain:
-                    url = domain.group(0)  # return the matched string
-
-                    # create ssl script for a site
-                    port = None
-                    if site_row[1]:
-                        port = site_row[1]  # if there's a second value, pass it in as the port
-                        script = "python3 ssl_cert.py {0} -p {1} {2}".format(url, port, arg_string)
-                    else:
-                        # print("python3 ssl_cert.py {0} {1}".format(url, arg_string))
-                        script = "python3 ssl_cert.py {0} {1}".format(url, arg_string)
-
-                    request = subprocess.Popen(script, stdout=subprocess.PIPE, universal_newlines=True,
-                                               shell=True)  # run script
-
-                    if request is None:
-                        print("script request '{0}' didn't return an output".format(script))
-                        return
-
-                    script_result, script_error = request.communicate()  # get result of script as a string. ignore errors
-
-                    # site = dict(literal_eval(script_result))  # convert string to dictionary
-                    site = json.loads(script_result)  # convert string to dictionary
-
-                    if port and (not port == 443):
-                        site["url"] = "http://{0}:{1}".format(url, port)  # add url to site object
-                        print(site["url"])
-                    else:
-                        site["url"] = "https://{0}".format(url)
-                        print(site["url"])
-
-                    # internal_site_list.append(site)
-                    site_list.append(site)
-                    # progress.increase()
-
-                else:
-                    print("'{0}' is not a valid domain - ignored".format(url))
-
-                site_queue.task_done()
-            return
-
-        q = queue.Queue()
-
-        for domain in domain_list:
-            q.put(domain)
-
-        thread_list = []
-
-        thread_no = 1
-        if 1 <= len(domain_list) <= self.thread_max:
-            thread_no = len(domain_list)
-        elif self.thread_max <= len(domain_list):
-            thread_no = self.thread_max
-
-        for i in range(thread_no):
-            t = threading.Thread(target=run_ssl_cert, args=(q,), name="thread {}".format(i))
-            thread_list.append(t)
-            t.setDaemon(True)
-            t.start()
-            # print("thread started: ", t.name)
-
-        for t in thread_list:
-            t.join()
-
-        q.join()
-
-        print("elapsed time for run_site_results (queue) completion: ", self.elapsed_time())
+        targets = [self.get_site_target(site_row) for site_row in domain_list]
+        targets = [target for target in targets if target]
+
+        schedule = None
+        if self.scheduled:
+            schedule = ProbeSchedule(conn)
+            targets, stored_sites = schedule.split_due(targets, forgiving)
+            site_list.extend(stored_sites.values())  # their countdowns are worked out when they are written out
+            print("probe schedule: {0}".format(schedule.stats))
+
+        # domains probed recently for any user are taken from the shared cache. domains being probed by another run
+        # right now are waited on rather than probed twice
+        unique_targets = list(dict.fromkeys(targets))
+        cache = ProbeCache(conn)
+        due_sites = cache.get_many(unique_targets, forgiving)
+
+        # unreachable domains are backed off - their last failure is returned until the backoff has passed. runs from
+        # the form, and domains the user has just added, always probe them, as the user may just have fixed the domain
+        backoff = ProbeBackoff(conn)
+        uncached = [target for target in unique_targets if target not in due_sites]
+        if self.interactive:
+            to_probe = uncached
+        else:
+            added = [ssl_cert.clean_url(site) for site in self.mySheet.sites_to_add or []]
+            to_probe, backed_off = backoff.split_backed_off(uncached, forgiving, exempt=added)
+            due_sites.update(backed_off)
+
+        latency = LatencyHistory(conn)  # each host's timeout comes from its connect and handshake latency history
+        timeouts = latency.get_timeouts(to_probe, int(timeout), int(timeout) if self.interactive else None)
+        durations = latency.expected_durations(to_probe, timeouts, int(timeout))
+        baselines = latency.baselines(to_probe) if self.probe_min_concurrency else {}  # for the adaptive concurrency limit
+        cache.lock_timeout = self.lock_timeout(durations, timeouts, timeout, forgiving)
+        owned, in_flight = cache.acquire(to_probe, forgiving)
+
+        resolver = Resolver(timeout=int(timeout))  # resolves every domain before probing starts
+        redirects.cache.connection = conn  # forgiving mode redirects are shared between runs
+        results, probed_sites = self.probe_targets(owned, forgiving, timeout, resolver, timeouts, durations,
+                                                   baselines, cache)
+        cache.store(probed_sites, forgiving)
+        due_sites.update(cache.wait_for(in_flight, forgiving, self.wait_budget(timeouts, timeout, forgiving)))
+
+        missed = [target for target in in_flight if target not in due_sites]  # the other run did not finish in time
+        missed_results, missed_sites = self.probe_targets(missed, forgiving, timeout, resolver, timeouts,
+                                                            durations, baselines, cache)
+        cache.store(missed_sites, forgiving)
+        cache.store_certificates()
+        results.extend(missed_results)
+        due_sites.update(probed_sites + missed_sites)
+        backoff.record(probed_sites + missed_sites, forgiving)
+        latency.record(results)
+
+        print("elapsed time for run_site_results ({0}) completion: ".format(self.probe_engine), self.elapsed_time())
+        print("probe cache: {0}".format(cache.stats))
+        print("probe backoff: {0}".format(backoff.stats))
+        print("latency history: {0}".format(latency.stats))
+        if forgiving:
+            print("redirect cache: {0}".format(redirects.cache.stats))
+        self.print_probe_stats(results, resolver)
+
+        for url, port in targets:
+            site = dict(due_sites[(url, port)])  # a copy, as the same domain may be listed more than once
+            site["url"] = self.site_url(url, port)  # cached sites may have been probed for a differently written url
+            site_list.append(site)
+        if schedule:
+            schedule.store([(target, due_sites[target]) for target in unique_targets], forgiving)
 
         if len(site_list) == 0:
             message = self.mySheet.no_values_message(self.mySheet.domains_tab_name)
             print(message)
             return 1, message
         else:
-            self.sorted_site_list = conversions.get_sorted_categories(site_list)
+            self.site_batch = SiteBatch.from_sites(site_list)
+            self.site_batch.categorise()
+            self.sorted_site_list = self.site_batch.categories()  # site views for the email and dashboard formatting
             return 0, self.sorted_site_list
 
+    def render_batch(self, sorted_site_list):
+        """ the SiteBatch of the sorted site list with the countdowns worked out now, as the results may have been
+        stored or cached, or the run queued in redis, since the sites were probed """
+        site_batch = self.site_batch
+        if sorted_site_list is not self.sorted_site_list or not site_batch:
+            site_batch = SiteBatch.from_categories(sorted_site_list)
+        site_batch.countdowns()
+        return site_batch
+
     def run_dashboard_update(self, sorted_site_list=None, mySheet=None, forgiving=None):
         sorted_site_list = self.sorted_site_list if not sorted_site_list else sorted_site_list
         # print(sorted_site_list)
@@ -139,50 +367,9 @@ class RunSSL:
         forgiving = self.forgiving if not forgiving else forgiving
 
         # Write to Google Sheet
-        values_list = []  # list of values to be written to the google sheet
-
-        # print("sort values to be written start:", time.time() - st)
-        for cat in sorted_site_list:
-            if sorted_site_list[cat]:  # if category isn't empty (i.e. if there are sites in the category)
-                for site in sorted_site_list[cat]:  # for each site in the category
-                    if site["ssl_status"] == "pass":
-                        to_write = []
-                        for key in mySheet.site_keys:  # values written in same order as GoogleSheets.site_keys()
-                            if key not in site:
-                                to_write.append("None")
-                            else:
-                                to_write.append(site[key])
-                        values_list.append(to_write)  # add this tuple to List to be written to the sheet
-                    else:
-                        if site["ssl_status"] == "missing":
-                            message = "** SSL certificate not found **"  # an error with no SSL date means there's no SSL
-                        elif site["ssl_status"] == "fail":
-                            message = "** Invalid SSL **"  # an error WITH an SSL date means there's some other SSL issue
-
-                        to_write_error = []
-                        for key in mySheet.site_keys:  # values written in same order as GoogleSheets.site_keys()
-                            if key == "url":
-                                to_write_error.append(site[key])
-                            elif key == "countdown":
-                                to_write_error.append(message)
-                            elif key == "error":
-                                to_write_error.append(site[key])
-                            elif key in site:
-                                to_write_error.append(site[key])
-                            else:
-                                to_write_error.append("")
-                        values_list.append(to_write_error)  # add this tuple to List to be written to the sheet
-
-        # print("sort values to be written end:", time.time() - st)
-
-        # convert the expiry and start times into the google sheet format
-        expiry_index = list(mySheet.dashboard_mapping.keys()).index("expiry")  # get index position based from position in the heading
-        start_index = list(mySheet.dashboard_mapping.keys()).index("start")  # get position of start key based on the headings
-        for site in values_list:
-            if site[expiry_index]:
-                site[expiry_index] = mySheet.google_time(site[expiry_index])  # replace item at list index with google time
-            if site[start_index]:
-                site[start_index] = mySheet.google_time(site[start_index])
+        site_batch = self.render_batch(sorted_site_list)
+        # list of values to be written to the google sheet, with the expiry, start and checked times as sheets dates
+        values_list = site_batch.rows(mySheet.site_keys, dates=mySheet.serial_dates)
 
         # print("update dashboard start:", time.time() - st)
         # Update Dashboard with retrieved site data.
@@ -246,7 +433,8 @@ class RunSSL:
         spreadsheet_title = mySheet.get_spreadsheet_title()
 
         # Create the SendEmail object. Stores sheetIds, tab names, etc
-        emailObj = SendEmail(sorted_site_list, dashboard_link, spreadsheet_title, refresh_link)
+        emailObj = SendEmail(self.render_batch(sorted_site_list).categories(), dashboard_link, spreadsheet_title,
+                             refresh_link)
 
         def send_email(email_queue: queue.Queue):
             while not email_queue.empty():
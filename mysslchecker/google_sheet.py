@@ -7,6 +7,7 @@ from datetime import datetime
 from collections import OrderedDict
 import conversions
 import pytz
+import numpy as np
 from copy import deepcopy
 import os
 
@@ -42,6 +43,7 @@ class GoogleSheet:
         self.domains_default_row = self.get_mapping_list(self.domain_mapping, "default")
         self.update_sheet_id = None
         self.update_tab_name = None
+        self.metadata = None  # spreadsheet title and tab ids, fetched once per run (see get_metadata)
         self.forgive = forgiving
 
 
@@ -64,6 +66,7 @@ class GoogleSheet:
         ("number", OrderedDict([("header", "Serial Number"), ("width", "170")])),
         ("issuer", OrderedDict([("header", "Issuer Details"), ("width", "250")])),
         ("error", OrderedDict([("header", "Additional Info"), ("width", "180")])),
+        ("checked", OrderedDict([("header", "Last Checked"), ("width", "170")])),
     ])
 
     email_mapping = OrderedDict([
@@ -271,20 +274,28 @@ class GoogleSheet:
                 if cat_key == sheet_value:
                     return self.cat_priority[cat_key]["validation"]
 
+    metadata_fields = "properties.title,sheets.properties(sheetId,title,index)"  # only what the lookups below need
+
+    def get_metadata(self, refresh=False):
+        """ the spreadsheet title and a dictionary of tab title: sheet id. fetched with a single request the first time
+        it is needed and kept for the run - tab id and title lookups are answered from it and create_sheet() adds new
+        tabs to it. refresh fetches it again """
+        if self.metadata is None or refresh:
+            request = self.service.spreadsheets().get(spreadsheetId=self.spreadsheet_id, fields=self.metadata_fields)
+            response = request.execute()
+            sheet_list = sorted(response.get("sheets", []), key=lambda sheet: sheet["properties"].get("index", 0))
+            self.metadata = {
+                "title": response["properties"]["title"],
+                "sheets": OrderedDict((sheet["properties"]["title"], sheet["properties"]["sheetId"]) for sheet in sheet_list)
+            }
+        return self.metadata
+
     def get_spreadsheet_title(self):
-        request = self.service.spreadsheets().get(spreadsheetId=self.spreadsheet_id)
-        response = request.execute()
-        title = response["properties"]["title"]
+        title = self.get_metadata()["title"]
         return title
 
     def get_sheet_info(self):
-        request = self.service.spreadsheets().get(spreadsheetId=self.spreadsheet_id)
-        response = request.execute()
-        sheet_list = response["sheets"]
-        titles = [sheet["properties"]["title"] for sheet in sheet_list]
-        ids = [sheet["properties"]["sheetId"] for sheet in sheet_list]
-
-        sheet_info = {title: ids for title, ids in zip(titles, ids)}
+        sheet_info = dict(self.get_metadata()["sheets"])
         return sheet_info
 
     def create_email_tab(self, tab_name, form_email_list=None):
@@ -608,8 +619,9 @@ class GoogleSheet:
             head_request = self.set_fmt_header_req(self.dashboard_tab_id, header_colour, end_column=len(self.site_keys))
             expiry_request = self.set_fmt_date_request("expiry")  # format the date in the corresponding column of the sheet
             start_request = self.set_fmt_date_request("start")  # format the date in the corresponding column of the sheet
+            checked_request = self.set_fmt_date_request("checked")  # when the certificate was probed - cached results can be older than the run
 
-            self.batch_update([head_request, expiry_request, start_request])
+            self.batch_update([head_request, expiry_request, start_request, checked_request])
 
             # Format site rows
             self.update_site_row_colours(sorted_site_list)  # updates the row colours for each site
@@ -623,19 +635,22 @@ class GoogleSheet:
         sheet_url = "https://docs.google.com/spreadsheets/d/{0}/#gid={1}".format(sheet_id, dashboard_id)
         return sheet_url
 
-    def get_sheet_id(self, tab_name):
-        """ get the worksheet id from the name """
-        a1_range = "{0}!A1".format(tab_name)
-
+    def get_sheet_id(self, tab_name, refresh=False):
+        """ get the worksheet id from the name, using the cached spreadsheet metadata. returns None if there is no tab
+        of that name. tab names are not case sensitive in google sheets """
         try:
-            request = self.service.spreadsheets().get(spreadsheetId=self.spreadsheet_id, ranges=str(a1_range))
-            response = request.execute()
-            sheet_id = response["sheets"][0]["properties"]["sheetId"]  # extracts sheetId
-            return sheet_id
+            sheets = self.get_metadata(refresh)["sheets"]
         except HttpError as err:
             print("sheet id not found. error message: {}".format(err.content))
             return None
 
+        if tab_name in sheets:
+            return sheets[tab_name]
+        for title, sheet_id in sheets.items():
+            if title.lower() == tab_name.lower():
+                return sheet_id
+        return None
+
     def get_domains(self):
         """ get the results object from spreadsheet and return the cell values """
         domains = []
@@ -676,7 +691,12 @@ class GoogleSheet:
             return None
 
     def create_sheet(self, title, index=None, tab_colour=None):
-        """ adds new sheet to existing spreadsheet. returns the new sheetId. Sets the tab color for the sheet """
+        """ adds new sheet to existing spreadsheet. returns the new sheetId. Sets the tab color for the sheet.
+        if the spreadsheet already has a tab of that title, returns its sheetId """
+
+        existing_id = self.get_sheet_id(title)
+        if existing_id is not None:
+            return existing_id  # no need to ask google to add it and be told that it already exists
 
         if tab_colour:
             red, blue, green = tab_colour.values()
@@ -707,9 +727,11 @@ class GoogleSheet:
             response = request.execute()
             new_sheet_id = response["replies"][0]["addSheet"]["properties"]["sheetId"]
             print("new sheet id: " + str(new_sheet_id))
+            if self.metadata is not None:
+                self.metadata["sheets"][title] = new_sheet_id  # keep the cached metadata current
         except HttpError as err:
             if "already exists" in str(err.content):
-                new_sheet_id = self.get_sheet_id(title)
+                new_sheet_id = self.get_sheet_id(title, refresh=True)  # added since the metadata was fetched
                 # self.clear_sheet(dashboard_title)
             else:
                 error_msg = str(err.content)
@@ -888,6 +910,14 @@ class GoogleSheet:
         # google_dt = dt.strftime(human_format)
         return google_dt
 
+    @staticmethod
+    def serial_dates(timestamps):
+        """ convert an array of timestamps into google sheets serial dates (days since 30 Dec 1899) in london time, in
+        one pass. the dates are written as numbers, so sheets does not parse them - the date columns are given a date
+        format by format_dashboard(). the same time as google_time() """
+        timestamps = np.floor(np.asarray(timestamps, dtype=np.float64))  # whole seconds, as google_time()
+        return (timestamps + conversions.london_offsets(timestamps)) / 86400 + 25569  # 25569 = serial date of 1 Jan 1970
+
 
 
 
@@ -0,0 +1,157 @@
+import json
+import os
+from redis.exceptions import RedisError
+from probe_cache import ProbeCache
+
+
+class LatencyHistory:
+    """ smoothed connect and handshake latency for each (host, port), kept in redis. each successful probe updates an
+    exponentially weighted moving average and mean deviation of both, in the same way as the tcp retransmission timer
+    (rfc 6298). a probe's timeout is then the sum over both stages of average + 'deviations' x deviation, multiplied
+    by 'margin' and clamped between 'floor' and 'ceiling' (or a lower cap, e.g. the run timeout of an interactive
+    run). hosts with no history use the timeout of the run.
+    probes that fail without completing a handshake are flagged so the host is expected to take its full timeout, and
+    the timeout is backed off as the tcp retransmission timer is (rfc 6298 section 5.5) - doubled for each failure in a
+    row and never less than the run timeout - so a host that has slowed down gets the time to record a new sample.
+    the next successful probe clears the failures """
+
+    key_prefix = "probe_latency"
+    stages = ("connect", "handshake")
+
+    def __init__(self, connection, alpha=0.125, beta=0.25, deviations=4, margin=2, floor=None, ceiling=None):
+        self.connection = connection  # redis connection (see worker.conn)
+        self.alpha = alpha  # weight of a new sample in the average
+        self.beta = beta  # weight of a new sample in the deviation
+        self.deviations = deviations
+        self.margin = margin
+        self.floor = floor if floor else float(os.getenv("SSL_TIMEOUT_FLOOR", 1))
+        self.ceiling = ceiling if ceiling else float(os.getenv("SSL_TIMEOUT_CEILING", 30))
+        self.histories = {}  # key: history entry (None if there is none) read or written by this run
+        self.stats = {"adaptive": 0, "default": 0, "backed_off": 0, "updated": 0}
+
+    def key(self, hostname, port):
+        return "{0}:{1}:{2}".format(self.key_prefix, ProbeCache.normalise(hostname), port or 443)
+
+    def read(self, targets):
+        """ the history entry (or None) of each target, in order. entries not already read by this run are fetched in
+        a single mget, so the timeouts, expected durations and baselines of a run share one round trip to redis """
+        keys = [self.key(url, port) for url, port in targets]
+        missing = list(dict.fromkeys(key for key in keys if key not in self.histories))
+        if missing:
+            try:
+                entries = self.connection.mget(missing)
+            except RedisError as err:
+                print("latency history unavailable: {0}".format(err))
+                entries = [None] * len(missing)
+            for key, entry in zip(missing, entries):
+                self.histories[key] = json.loads(entry) if entry else None
+        return [self.histories[key] for key in keys]
+
+    @classmethod
+    def has_samples(cls, history):
+        return bool(history) and all(stage in history for stage in cls.stages)
+
+    def timeout_from(self, history):
+        """ the probe timeout for a latency history entry """
+        expected = sum(history[stage]["average"] + self.deviations * history[stage]["deviation"] for stage in self.stages)
+        return max(self.floor, min(self.ceiling, expected * self.margin))
+
+    def get_timeouts(self, targets, default_timeout=None, cap=None):
+        """ returns a dictionary of (url, port): timeout for the targets with a latency history. default_timeout is the
+        run timeout, the least a host whose last probe failed is given. cap is the most any host is given """
+        timeouts = {}
+        for target, history in zip(targets, self.read(targets)):
+            if self.has_samples(history):
+                timeouts[target] = self.timeout_from(history)
+                if history.get("failed"):
+                    backed_off = min(self.ceiling, timeouts[target] * 2 ** history.get("failures", 1))
+                    timeouts[target] = max(backed_off, default_timeout) if default_timeout else backed_off
+                    self.stats["backed_off"] += 1
+                if cap:
+                    timeouts[target] = min(timeouts[target], cap)
+        self.stats["adaptive"] += len(timeouts)
+        self.stats["default"] += len(targets) - len(timeouts)
+        return timeouts
+
+    def expected_durations(self, targets, timeouts, default_timeout):
+        """ returns a dictionary of (url, port): the seconds a probe of the target is expected to take. hosts with no
+        history, or whose last probe failed, are expected to run to their timeout """
+        durations = {}
+        for target, history in zip(targets, self.read(targets)):
+            if self.has_samples(history) and not history.get("failed"):
+                durations[target] = sum(history[stage]["average"] for stage in self.stages)
+            else:
+                durations[target] = timeouts.get(target, default_timeout)
+        return durations
+
+    def baselines(self, targets):
+        """ returns a dictionary of (url, port): the host's average connect plus handshake seconds, for the targets
+        with a latency history whose last probe succeeded. the adaptive concurrency limit compares each probe with its
+        own host's baseline (see probe_limits.AIMDLimiter) """
+        baselines = {}
+        for target, history in zip(targets, self.read(targets)):
+            if self.has_samples(history) and not history.get("failed"):
+                baselines[target] = sum(history[stage]["average"] for stage in self.stages)
+        return baselines
+
+    def update(self, history, samples):
+        """ fold the {stage: seconds} samples into the history entry (or start one) """
+        history = history if history else {}
+        for stage in self.stages:
+            sample = samples[stage]
+            if stage not in history:
+                history[stage] = {"average": sample, "deviation": sample / 2}  # first sample (rfc 6298 section 2.2)
+            else:
+                average = history[stage]["average"]
+                deviation = history[stage]["deviation"]
+                history[stage]["deviation"] = (1 - self.beta) * deviation + self.beta * abs(average - sample)
+                history[stage]["average"] = (1 - self.alpha) * average + self.alpha * sample
+        return history
+
+    def record(self, results):
+        """ update the history from each ssl_cert.ProbeResult that timed both its connect and handshake. results with
+        no certificate flag the host as failed and count the failures in a row. an entry is dropped after 30 days
+        without a timed probe - failures do not extend it, so an old history cannot be kept alive by failing probes """
+        updates = []  # (result, timed)
+        for result in results:
+            if all(stage in result.peer for stage in self.stages):
+                updates.append((result, True))
+            elif not result.certificate:
+                updates.append((result, False))
+        if not updates:
+            return
+        expiry = 30 * 24 * 60 * 60
+        try:
+            keys = [self.key(result.hostname, result.port) for result, timed in updates]
+            pipeline = self.connection.pipeline(transaction=False)
+            for key in keys:
+                pipeline.get(key)
+                pipeline.ttl(key)
+            replies = pipeline.execute()
+            entries = dict(zip(keys, replies[0::2]))
+            ttls = dict(zip(keys, replies[1::2]))
+            histories = {}
+            sampled = set()  # keys with a new timed sample in this run
+            for key, (result, timed) in zip(keys, updates):
+                history = histories.get(key, json.loads(entries[key]) if entries[key] else None)
+                if timed:
+                    history = self.update(history, {stage: result.peer[stage] for stage in self.stages})
+                    history["failed"] = False
+                    history["failures"] = 0
+                    sampled.add(key)
+                else:
+                    history = history if history else {}
+                    history["failed"] = True
+                    history["failures"] = history.get("failures", 0) + 1
+                histories[key] = history
+
+            pipeline = self.connection.pipeline(transaction=False)
+            for key, history in histories.items():
+                ttl = ttls[key] if ttls[key] and ttls[key] > 0 else None
+                pipeline.set(key, json.dumps(history), ex=expiry if key in sampled or not ttl else ttl)
+            pipeline.execute()
+        except RedisError as err:
+            print("unable to update the latency history: {0}".format(err))
+            return
+        self.histories.update(histories)
+        self.stats["updated"] += len(updates)
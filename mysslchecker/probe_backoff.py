@@ -0,0 +1,85 @@
+import json
+import time
+from redis.exceptions import RedisError
+from probe_cache import ProbeCache
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+
+
+class ProbeBackoff:
+    """ negative cache for unreachable domains, kept in redis. each run that cannot retrieve a certificate for a
+    (host, port) adds to its count of consecutive failures, and the domain is not probed again until its backoff has
+    passed: 'base_delay' doubled for each further failure, up to 'max_delay'. the first backoff is short, so one
+    transient failure does not hide a domain for long. while a domain is backed off its last failed site object is
+    returned straight away. a successful probe clears the failures """
+
+    key_prefix = "probe_backoff"
+
+    def __init__(self, connection, base_delay=15 * MINUTE, max_delay=7 * 24 * HOUR):
+        self.connection = connection  # redis connection (see worker.conn)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"backed_off": 0, "failed": 0, "recovered": 0}
+
+    def key(self, hostname, port, forgiving):
+        return "{0}:{1}:{2}:{3}".format(self.key_prefix, ProbeCache.normalise(hostname), port or 443,
+                                        "forgiving" if forgiving else "strict")
+
+    @staticmethod
+    def is_unreachable(site):
+        """ no certificate was retrieved - matches the 'missing' status of conversions.get_sorted_categories() """
+        return "expiry" not in site
+
+    def backoff_delay(self, failures):
+        """ seconds before a domain with this many consecutive failures is probed again """
+        return min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+
+    def split_backed_off(self, targets, forgiving, now=None, exempt=None):
+        """ returns a tuple of the (url, port) targets to probe, and a dictionary of target: last failed site for the
+        targets that are backed off. backed off sites are marked with "backed_off" set to the time of the next probe.
+        targets whose hostname is in exempt (e.g. domains the user has just added) are always probed """
+        now = now if now else time.time()
+        if not targets:
+            return [], {}
+        try:
+            entries = self.connection.mget([self.key(url, port, forgiving) for url, port in targets])
+        except RedisError as err:
+            print("probe backoff unavailable: {0}".format(err))
+            return list(targets), {}
+
+        exempt = set(ProbeCache.normalise(hostname) for hostname in exempt) if exempt else set()
+        to_probe = []
+        backed_off = {}
+        for target, entry in zip(targets, entries):
+            entry = json.loads(entry) if entry else None
+            if entry and entry["retry_at"] > now and ProbeCache.normalise(target[0]) not in exempt:
+                site = entry["site"]
+                site["backed_off"] = entry["retry_at"]
+                backed_off[target] = site
+            else:
+                to_probe.append(target)
+        self.stats["backed_off"] += len(backed_off)
+        return to_probe, backed_off
+
+    def record(self, site_targets, forgiving, now=None):
+        """ update the failure count for each probed ((url, port), site) pair """
+        now = now if now else time.time()
+        failed = [(target, site) for target, site in site_targets if self.is_unreachable(site)]
+        recovered = [(target, site) for target, site in site_targets if not self.is_unreachable(site)]
+        try:
+            entries = self.connection.mget([self.key(url, port, forgiving) for (url, port), site in failed]) if failed else []
+            pipeline = self.connection.pipeline(transaction=False)
+            for ((url, port), site), entry in zip(failed, entries):
+                failures = json.loads(entry)["failures"] + 1 if entry else 1
+                retry_at = now + self.backoff_delay(failures)
+                entry = {"failures": failures, "retry_at": retry_at, "site": site}
+                pipeline.set(self.key(url, port, forgiving), json.dumps(entry), ex=self.max_delay * 2)
+            for (url, port), site in recovered:
+                pipeline.delete(self.key(url, port, forgiving))
+            replies = pipeline.execute()
+        except RedisError as err:
+            print("unable to update the probe backoff: {0}".format(err))
+            return
+        self.stats["failed"] += len(failed)
+        self.stats["recovered"] += sum(replies[len(failed):])  # domains that had failures before this run
@@ -0,0 +1,160 @@
+import base64
+import json
+import os
+import time
+import uuid
+from redis.exceptions import RedisError
+
+
+class ProbeCache:
+    """ site objects shared between every user and run through redis, so a domain listed by many users is only probed
+    once per 'ttl' seconds. entries are keyed by the normalised (host, port, forgiving).
+
+    a single-flight lock is taken before probing a domain. if another run already holds the lock, that run's result is
+    waited on rather than starting a second probe. if redis cannot be reached every domain is probed as usual.
+
+    the certificate each host served is kept as well, so the re-probe of the domain a failing host redirects to in
+    forgiving mode is answered from the cache when that domain has been probed itself """
+
+    key_prefix = "probe_cache"
+    lock_prefix = "probe_cache_lock"
+    certificate_prefix = "probe_cache_cert"
+
+    # delete the lock only if it is still held by this run (it may have expired and been taken by another run)
+    release_script = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    def __init__(self, connection, ttl=None, lock_timeout=60, poll_interval=0.5):
+        self.connection = connection  # redis connection (see worker.conn)
+        self.ttl = ttl if ttl else int(os.getenv("SSL_PROBE_CACHE_TTL", 900))  # seconds a cached site can be reused for
+        self.lock_timeout = lock_timeout  # a lock is released after this many seconds if the run holding it dies
+        self.poll_interval = poll_interval
+        self.token = uuid.uuid4().hex  # identifies the locks held by this run
+        self.certificates = {}  # (hostname, port): (der certificate, ssl error) served by hosts probed in this run
+        self.stats = {"hits": 0, "misses": 0, "waited": 0,  # waited - hits that were probed by another run during this one
+                      "certificate_hits": 0, "certificate_misses": 0}
+
+    @staticmethod
+    def normalise(hostname):
+        """ the hostname as it is keyed in redis - hostnames are case insensitive and may be written with a scheme, a
+        path or a trailing dot (e.g. https://Example.com/page -> example.com) """
+        hostname = hostname.strip().lower().split("://", 1)[-1]
+        return hostname.split("/", 1)[0].rstrip(".")
+
+    def key(self, hostname, port, forgiving, prefix=None):
+        prefix = prefix if prefix else self.key_prefix
+        return "{0}:{1}:{2}:{3}".format(prefix, self.normalise(hostname), port or 443,
+                                        "forgiving" if forgiving else "strict")
+
+    def get_many(self, targets, forgiving, count_misses=True):
+        """ returns a dictionary of (url, port) target: cached site for each target that is in the cache. cached sites
+        are marked with "cached": True and keep the "checked" time of the original probe """
+        if not targets:
+            return {}
+        try:
+            entries = self.connection.mget([self.key(url, port, forgiving) for url, port in targets])
+        except RedisError as err:
+            print("probe cache unavailable: {0}".format(err))
+            return {}
+
+        cached_sites = {}
+        for target, entry in zip(targets, entries):
+            if entry:
+                site = json.loads(entry)
+                site["cached"] = True
+                cached_sites[target] = site
+        self.stats["hits"] += len(cached_sites)
+        if count_misses:
+            self.stats["misses"] += len(targets) - len(cached_sites)
+        return cached_sites
+
+    def acquire(self, targets, forgiving):
+        """ take the single-flight lock for each target. returns a tuple of the targets this run should probe and the
+        targets that are already being probed by another run. every lock is taken before probing starts, so
+        lock_timeout should cover the whole run rather than a single probe """
+        if not targets:
+            return [], []
+        try:
+            pipeline = self.connection.pipeline(transaction=False)
+            for url, port in targets:
+                pipeline.set(self.key(url, port, forgiving, self.lock_prefix), self.token, nx=True, ex=self.lock_timeout)
+            acquired = pipeline.execute()
+        except RedisError as err:
+            print("probe cache locks unavailable: {0}".format(err))
+            return list(targets), []
+
+        owned = [target for target, locked in zip(targets, acquired) if locked]
+        in_flight = [target for target, locked in zip(targets, acquired) if not locked]
+        return owned, in_flight
+
+    def store(self, site_targets, forgiving):
+        """ cache the site object for each ((url, port), site) pair and release the locks held for them """
+        if not site_targets:
+            return
+        try:
+            pipeline = self.connection.pipeline(transaction=False)
+            for (url, port), site in site_targets:
+                pipeline.set(self.key(url, port, forgiving), json.dumps(site), ex=self.ttl)
+            for (url, port), site in site_targets:
+                pipeline.eval(self.release_script, 1, self.key(url, port, forgiving, self.lock_prefix), self.token)
+            pipeline.execute()
+        except RedisError as err:
+            print("unable to update the probe cache: {0}".format(err))
+
+    def keep_certificate(self, hostname, port, der_cert, ssl_error):
+        """ remember the certificate a host served (and whether it failed verification) for get_certificate(). kept
+        in the process until store_certificates() """
+        self.certificates[(self.normalise(hostname), port or 443)] = (der_cert, ssl_error)
+
+    def get_certificate(self, hostname, port):
+        """ the (der certificate, ssl error) tuple the host served in this run or a recent one, or None """
+        certificate = self.certificates.get((self.normalise(hostname), port or 443))
+        if certificate is None:
+            try:
+                entry = self.connection.get(self.key(hostname, port, False, self.certificate_prefix))
+            except RedisError as err:
+                print("probe cache unavailable: {0}".format(err))
+                entry = None
+            if entry:
+                entry = json.loads(entry)
+                certificate = (base64.b64decode(entry["der"]), entry["ssl_error"])
+        self.stats["certificate_hits" if certificate else "certificate_misses"] += 1
+        return certificate
+
+    def store_certificates(self):
+        """ cache the certificates kept by this run, for the same ttl as the sites """
+        if not self.certificates:
+            return
+        try:
+            pipeline = self.connection.pipeline(transaction=False)
+            for (hostname, port), (der_cert, ssl_error) in self.certificates.items():
+                entry = {"der": base64.b64encode(der_cert).decode("ascii"), "ssl_error": ssl_error}
+                pipeline.set(self.key(hostname, port, False, self.certificate_prefix), json.dumps(entry), ex=self.ttl)
+            pipeline.execute()
+        except RedisError as err:
+            print("unable to update the probe cache: {0}".format(err))
+
+    def wait_for(self, targets, forgiving, timeout=None):
+        """ wait for the runs holding the locks to cache their results, for up to timeout seconds (default
+        lock_timeout). returns a dictionary of target: cached site. targets missing from the result (the other run
+        failed, the lock timed out or the wait ran out) should be probed by the caller """
+        cached_sites = {}
+        remaining = list(targets)
+        deadline = time.time() + (self.lock_timeout if timeout is None else min(timeout, self.lock_timeout))
+        while remaining and time.time() < deadline:
+            found = self.get_many(remaining, forgiving, count_misses=False)
+            cached_sites.update(found)
+            remaining = [target for target in remaining if target not in found]
+            if not remaining:
+                break
+            try:
+                locks = self.connection.mget([self.key(url, port, forgiving, self.lock_prefix) for url, port in remaining])
+            except RedisError:
+                break
+            if not any(locks):
+                break  # the locks have gone without a result being cached - one last check, then give up
+            time.sleep(self.poll_interval)
+
+        if remaining:
+            cached_sites.update(self.get_many(remaining, forgiving, count_misses=False))
+        self.stats["waited"] += len(cached_sites)
+        return cached_sites
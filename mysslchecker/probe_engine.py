@@ -0,0 +1,428 @@
+import asyncio
+import socket
+import ssl
+import time
+from collections import deque
+from OpenSSL import SSL
+import ssl_cert
+from probe_limits import AIMDLimiter, DestinationLimits
+
+
+class ProbeEngine:
+    """ probes certificates for many hosts at once on a single asyncio event loop. each probe waits on the
+    network rather than on a thread, so the number of concurrent handshakes is limited only by 'concurrency'. if
+    'min_concurrency' is set the limit adapts between the two (see probe_limits.AIMDLimiter). if 'share' is set the
+    limit is also kept within the run's share of the probes across every process (see probe_pool.ProbePool).
+    results are the same ssl_cert.ProbeResult objects returned by ssl_cert.probe() """
+
+    def __init__(self, timeout=5, forgiving=False, concurrency=500, deadline=None, capture=False, resolver=None,
+                 all_addresses=False, address_fanout=ssl_cert.ADDRESS_FANOUT, timeouts=None, hedge=False,
+                 hedge_budget=0.05, cert_options=None, min_concurrency=None, destinations=None, baselines=None,
+                 share=None, probe_cache=None):
+        self.timeout = timeout  # per handshake, as with ssl_cert.get_der_cert
+        self.timeouts = timeouts if timeouts else {}  # (hostname, port): timeout for hosts with a latency history (see latency.LatencyHistory)
+        self.forgiving = forgiving
+        self.capture = capture  # single handshake with offline verification (see ssl_cert.capture_der_cert)
+        self.resolver = resolver  # resolver.Resolver - if set, every hostname is resolved before probing starts
+        self.concurrency = concurrency  # max number of probes in flight at the same time
+        self.min_concurrency = min_concurrency if min_concurrency and min_concurrency < concurrency else None
+        self.share = share  # probe_pool.ProbeShare - the run's share of the probes across every process
+        self.probe_cache = probe_cache  # probe_cache.ProbeCache - keeps each host's certificate for redirect re-probes
+        self.limiter = None  # adaptive concurrency limit if min_concurrency is set, or a fixed one resized to the share
+        self.baselines = baselines if baselines else {}  # (hostname, port): usual connect and handshake seconds, for the limiter
+        if self.min_concurrency or share:
+            self.limiter = AIMDLimiter(min_limit=self.min_concurrency or concurrency, max_limit=concurrency)
+        self.destinations = destinations if destinations else DestinationLimits(0, 0)  # per address and domain caps
+        self.all_addresses = all_addresses  # probe every resolved address of a host rather than the first to connect
+        self.address_fanout = address_fanout  # max concurrent probes per host in all addresses mode
+        self.deadline = deadline  # max time for a whole probe (including retries and redirects). defaults to default_deadline()
+        self.cert_options = cert_options if cert_options else {}
+        self.hedge = hedge  # start a second attempt for handshakes slower than the run's p95 (see hedged_fetch_der_cert)
+        self.hedge_budget = hedge_budget  # max hedged attempts as a fraction of all attempts
+        self.hedge_min_samples = 20  # handshakes needed before the p95 is trusted
+        self.latencies = deque(maxlen=1000)  # seconds taken by the most recent successful handshakes
+        self.hedge_stats = {"attempts": 0, "fired": 0, "won": 0, "capped": 0}
+
+    def timeout_for(self, hostname, port):
+        """ the handshake timeout for the host - from its latency history if there is one, else the engine timeout """
+        return self.timeouts.get((hostname, port), self.timeout)
+
+    def deadline_for(self, hostname, port):
+        return self.deadline if self.deadline else self.default_deadline(self.timeout_for(hostname, port), self.forgiving)
+
+    @staticmethod
+    def default_deadline(timeout, forgiving):
+        """ worst case for a probe is a handshake plus an sslv23 retry. forgiving mode can add a redirect and a
+        further handshake and retry on the redirected domain. capture mode needs less but shares the same limit """
+        return timeout * 5 if forgiving else timeout * 2
+
+    @staticmethod
+    async def connect_socket(family, address, port):
+        """ returns a non-blocking socket connected to the address """
+        loop = asyncio.get_event_loop()
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (address, port))
+            return sock
+        except BaseException:
+            sock.close()  # failed or cancelled by a timeout
+            raise
+
+    async def open_socket(self, hostname, port, addresses, delay=ssl_cert.HAPPY_EYEBALLS_DELAY):
+        """ asyncio version of ssl_cert.happy_eyeballs_connect - staggered connection attempts across the pre-resolved
+        (family, address) tuples, each with its own timeout. returns the first socket to connect """
+        pending = ssl_cert.interleave_addresses(addresses)
+        if not pending:
+            raise OSError("no addresses found for {0}".format(hostname))
+
+        attempts = set()
+        last_error = None
+        try:
+            while pending or attempts:
+                if pending:
+                    family, address = pending.pop(0)
+                    attempts.add(asyncio.ensure_future(
+                        asyncio.wait_for(self.connect_socket(family, address, port), self.timeout_for(hostname, port))))
+
+                # wait for the delay before starting the next attempt, or for as long as it takes once all have started
+                done, attempts = await asyncio.wait(attempts, timeout=delay if pending else None,
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        for other in done - {attempt}:
+                            if other.exception() is None:
+                                other.result().close()
+                        return attempt.result()
+                    last_error = attempt.exception()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+        raise last_error
+
+    async def open_connection(self, hostname, port, addresses, peer=None, **kwargs):
+        """ asyncio.open_connection() using the pre-resolved addresses if there are any, else the hostname. the address
+        and family that connected are stored in the peer dictionary if provided """
+        if addresses is None:
+            reader, writer = await asyncio.open_connection(hostname, port, **kwargs)
+            try:
+                ssl_cert.record_peer(writer.get_extra_info("socket"), peer)  # connect and handshake are not timed separately
+            except OSError:
+                pass  # the connection has already dropped - the handshake will report it
+            return reader, writer
+
+        started = time.time()
+        sock = await self.open_socket(hostname, port, addresses)
+        try:
+            ssl_cert.record_peer(sock, peer, started)
+        except OSError:
+            pass
+        return await asyncio.open_connection(sock=sock, **kwargs)
+
+    async def get_der_cert(self, hostname, port, error_message, sslv23=False, error_count=0, addresses=None,
+                           peer=None):
+        """ asyncio version of ssl_cert.get_der_cert - returns a tuple of the der certificate bytes (or None) and whether
+        an ssl error was encountered on the way """
+        if error_count >= 2:
+            return None, False
+
+        context = ssl_cert.get_context(sslv23)
+        try:
+            connection = self.open_connection(hostname, port, addresses, peer, ssl=context, server_hostname=hostname)
+            reader, writer = await asyncio.wait_for(connection, self.timeout_for(hostname, port))
+            ssl_cert.record_handshake(peer)
+            try:
+                der_cert = writer.get_extra_info("ssl_object").getpeercert(True)
+            finally:
+                writer.close()
+            return der_cert, False
+        except asyncio.TimeoutError:
+            error_04 = "*Timed out during original certificate retrieval*"
+            error_message.append(error_04)
+            return None, False
+        except ssl.CertificateError as cert_err:
+            error_12 = "SSL Certificate error: {0} ".format(cert_err)
+            error_message.append(error_12)
+            der_cert, _ = await self.get_der_cert(hostname, port, error_message, sslv23=True, error_count=error_count + 1,
+                                                  addresses=addresses, peer=peer)
+            return der_cert, True
+        except ssl.SSLError:
+            der_cert, _ = await self.get_der_cert(hostname, port, error_message, sslv23=True, error_count=error_count + 1,
+                                                  addresses=addresses, peer=peer)
+            return der_cert, True
+        except Exception:
+            error_05 = "* Unable to connect to {0}. *".format(hostname)
+            error_message.append(error_05)
+            return None, False
+
+    async def capture_handshake(self, hostname, port, addresses=None, peer=None):
+        """ drives an unverified pyOpenSSL handshake over an asyncio stream. returns the peer certificate chain """
+        reader, writer = await self.open_connection(hostname, port, addresses, peer)
+        try:
+            connection = ssl_cert.create_capture_connection(hostname, port)
+            while True:
+                try:
+                    connection.do_handshake()
+                    break
+                except SSL.WantReadError:
+                    writer.write(ssl_cert.read_outgoing(connection))
+                    data = await reader.read(16384)
+                    if not data:
+                        raise SSL.Error("connection closed during handshake")
+                    connection.bio_write(data)
+            writer.write(ssl_cert.read_outgoing(connection))  # complete the handshake from our side
+            ssl_cert.record_handshake(peer)
+            return ssl_cert.get_captured_chain(connection)
+        finally:
+            writer.close()
+
+    async def capture_der_cert(self, hostname, port, error_message, addresses=None, peer=None):
+        """ asyncio version of ssl_cert.capture_der_cert - one unverified handshake then offline verification """
+        try:
+            chain = await asyncio.wait_for(self.capture_handshake(hostname, port, addresses, peer),
+                                           self.timeout_for(hostname, port))
+        except asyncio.TimeoutError:
+            error_04 = "*Timed out during original certificate retrieval*"
+            error_message.append(error_04)
+            return None, False
+        except SSL.Error as ssl_err:
+            error_message.append(ssl_cert.handshake_error(ssl_err))  # the handshake failed - no certificate to verify
+            return None, True
+        except Exception:
+            error_05 = "* Unable to connect to {0}. *".format(hostname)
+            error_message.append(error_05)
+            return None, False
+
+        if not chain:
+            return None, False
+        return ssl_cert.check_captured_chain(hostname, chain, error_message)
+
+    async def fetch_der_cert(self, hostname, port, error_message, addresses=None, peer=None):
+        """ returns the (der_cert, ssl_error) tuple using the engine's handshake mode """
+        if self.capture:
+            return await self.capture_der_cert(hostname, port, error_message, addresses, peer)
+        return await self.get_der_cert(hostname, port, error_message, addresses=addresses, peer=peer)
+
+    def hedge_delay(self):
+        """ the p95 handshake time of the run so far, or None if hedging is off, there are too few handshakes to judge
+        or the extra load budget has been used """
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        if self.hedge_stats["fired"] >= self.hedge_budget * self.hedge_stats["attempts"]:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(len(latencies) * 0.95)]
+
+    async def timed_fetch_der_cert(self, hostname, port, error_message, addresses=None, peer=None):
+        """ fetch_der_cert, recording the time of successful handshakes for the hedging p95 """
+        started = time.time()
+        der_cert, ssl_error = await self.fetch_der_cert(hostname, port, error_message, addresses, peer)
+        if der_cert:
+            self.latencies.append(time.time() - started)
+        return der_cert, ssl_error
+
+    async def hedged_fetch_der_cert(self, hostname, port, error_message, addresses=None, peer=None):
+        """ fetch_der_cert with hedging. if the handshake is still running after the run's p95 handshake time, a second
+        attempt is started and the first to return a certificate wins - the other is cancelled. if neither returns one,
+        the first attempt's errors are reported. handshakes stalled on
+        packet loss often complete straight away when tried again. the second attempt takes its own destination slot,
+        and is not started if the host is at its per address or per domain cap """
+        if not self.hedge:
+            return await self.fetch_der_cert(hostname, port, error_message, addresses, peer)
+
+        self.hedge_stats["attempts"] += 1
+        primary_errors, primary_peer = [], {}
+        primary = asyncio.ensure_future(self.timed_fetch_der_cert(hostname, port, primary_errors, addresses,
+                                                                  primary_peer))
+        attempts = {primary: (primary_errors, primary_peer)}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, pending = await asyncio.wait([primary], timeout=delay)
+                if pending and self.hedge_delay() is not None:  # the budget may have been used while waiting
+                    keys = self.destinations.keys(hostname, ssl_cert.first_address(addresses))
+                    if self.destinations.blocked(keys) is None:
+                        self.hedge_stats["fired"] += 1
+                        hedge_errors, hedge_peer = [], {}
+                        self.destinations.take(keys)  # the second attempt holds its own destination slot
+                        hedge = asyncio.ensure_future(self.timed_fetch_der_cert(hostname, port, hedge_errors, addresses,
+                                                                                hedge_peer))
+                        hedge.add_done_callback(lambda attempt: self.destinations.release(keys))  # even if cancelled
+                        attempts[hedge] = (hedge_errors, hedge_peer)
+                    else:
+                        self.hedge_stats["capped"] += 1  # the host is at its destination caps - don't add to its load
+
+            pending = set(attempts)
+            winner = primary  # the primary's result is reported unless another attempt returns a certificate
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                finished = [attempt for attempt in done if attempt.result()[0]]
+                if finished:
+                    winner = primary if primary in finished else finished[0]
+                    break
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+        if winner is not primary:
+            self.hedge_stats["won"] += 1
+        winner_errors, winner_peer = attempts[winner]
+        error_message.extend(winner_errors)
+        peer.update(winner_peer)
+        return winner.result()
+
+    async def fetch(self, result, addresses=None, forgiving=None):
+        """ get the der certificate for the probe result, following a redirect in forgiving mode """
+        forgiving = self.forgiving if forgiving is None else forgiving
+        der_cert, ssl_error = await self.hedged_fetch_der_cert(result.hostname, result.port, result.errors, addresses,
+                                                               result.peer)
+        if der_cert and self.probe_cache:
+            self.probe_cache.keep_certificate(result.hostname, result.port, der_cert, ssl_error)
+
+        if not der_cert and forgiving:
+            # the redirect lookup is blocking so runs in the loop's thread pool. errors are collected separately as the
+            # thread carries on after a deadline cancels this coroutine
+            redirect_errors = []
+            loop = asyncio.get_event_loop()
+            redirect_hostname = await loop.run_in_executor(None, ssl_cert.find_redirect, result.hostname,
+                                                           self.timeout_for(result.hostname, result.port), redirect_errors)
+            result.errors.extend(redirect_errors)
+            if redirect_hostname:
+                cached = None
+                if self.probe_cache:
+                    # the redirected domain's certificate if it has been probed recently (the lookup may go to redis)
+                    cached = await loop.run_in_executor(None, self.probe_cache.get_certificate, redirect_hostname,
+                                                        result.port)
+                if cached:
+                    der_cert, forgiving_error = cached
+                else:
+                    # the redirected domain is probed like any other - resolved through the dns cache first
+                    redirect_addresses = await self.resolver.resolve(redirect_hostname) if self.resolver else None
+                    der_cert, forgiving_error = await self.fetch_der_cert(redirect_hostname, result.port,
+                                                                          result.errors, redirect_addresses)
+                result.errors.append(ssl_cert.redirect_message(redirect_hostname, der_cert, forgiving_error))
+
+        return der_cert
+
+    async def probe(self, host, port=443, addresses=None, forgiving=None):
+        """ probe a single host, giving up once the deadline is reached. returns a ssl_cert.ProbeResult """
+        hostname = ssl_cert.clean_url(host)
+        result = ssl_cert.ProbeResult(hostname, port)
+        if self.resolver:
+            result.timings["resolve"] = self.resolver.lookup_times.get(hostname, 0.0)
+        deadline = self.deadline_for(hostname, port)
+        started = time.time()
+
+        try:
+            der_cert = await asyncio.wait_for(self.fetch(result, addresses, forgiving), deadline)
+        except asyncio.TimeoutError:
+            error_15 = "*Probe deadline of {0} seconds exceeded*".format(round(deadline, 2))
+            result.errors.append(error_15)
+            der_cert = None
+
+        result.timings["tls"] = time.time() - started
+        self.apply_share()  # probes waiting for a slot pick up a change of share as others complete
+        if self.limiter:
+            latency, timed_out = self.congestion_signal(result)
+            self.limiter.record(latency, timed_out, self.baselines.get((hostname, port)))
+        return ssl_cert.load_certificate(result, der_cert, **self.cert_options)
+
+    @staticmethod
+    def congestion_signal(result):
+        """ returns the (latency, timed out) of a probe for the adaptive concurrency limit. latency is the connect and
+        handshake time, or None if the handshake did not complete """
+        latency = None
+        if "connect" in result.peer and "handshake" in result.peer:
+            latency = result.peer["connect"] + result.peer["handshake"]
+        timed_out = any("Timed out" in error or "deadline" in error for error in result.errors)
+        return latency, timed_out
+
+    def apply_share(self):
+        """ keep the limit within the run's current share of the probe pool. a fixed limit follows the share, an
+        adaptive one keeps adapting below it """
+        if not self.share:
+            return
+        limit = min(self.concurrency, self.share.limit)
+        if limit != self.limiter.max_limit:
+            self.limiter.resize(limit, min(self.min_concurrency or limit, limit))
+
+    def slot_taken(self, queued_at):
+        """ a queued probe got its slot - counted in the run's share of the probe pool, which publishes the run's
+        queue depth and wait time. probes that were not queued (the redirect probe after all addresses failed) pass
+        None """
+        if self.share and queued_at is not None:
+            self.share.started(queued_at)
+
+    async def probe_each_address(self, host, port, addresses, semaphore, queued_at=None):
+        """ asyncio version of ssl_cert.probe_each_address - probes every address of the host concurrently, no more
+        than 'address_fanout' at a time. each probe also takes a slot from the engine-wide limit. queued_at is the time
+        the probes were queued at in the run's share (see slot_taken) """
+        hostname = ssl_cert.clean_url(host)
+        fanout = asyncio.Semaphore(self.address_fanout)
+
+        async def probe_address(family, address):
+            keys = self.destinations.keys(hostname, [(family, address)])
+            async with fanout:
+                await self.destinations.acquire(keys)
+                try:
+                    self.apply_share()
+                    async with semaphore:
+                        self.slot_taken(queued_at)
+                        result = await self.probe(hostname, port, [(family, address)], forgiving=False)
+                finally:
+                    self.destinations.release(keys)
+            result.peer.setdefault("address", address)
+            result.peer.setdefault("family", ssl_cert.ADDRESS_FAMILIES.get(family, str(family)))
+            return result
+
+        results = await asyncio.gather(*[probe_address(family, address) for family, address in addresses])
+
+        merged = ssl_cert.merge_address_results(hostname, port, list(results))
+        if not merged.certificate and self.forgiving:
+            return await self.polite_probe(host, port, addresses, semaphore)  # no certificate from any address - follow a redirect
+        return merged
+
+    async def polite_probe(self, host, port, addresses, semaphore, queued_at=None):
+        """ probe once the host's destinations are under their caps and a slot is free in the engine-wide limit. the
+        destination is waited on first, so a busy destination does not hold slots that other hosts could use """
+        keys = self.destinations.keys(ssl_cert.clean_url(host), ssl_cert.first_address(addresses))
+        await self.destinations.acquire(keys)
+        try:
+            self.apply_share()
+            async with semaphore:
+                self.slot_taken(queued_at)
+                return await self.probe(host, port, addresses)
+        finally:
+            self.destinations.release(keys)
+
+    async def probe_all(self, targets):
+        """ probe every (host, port) target with no more than 'concurrency' probes (or the adaptive limit) running at
+        once. if the engine has a resolver, all the hostnames are resolved first. in all addresses mode each address
+        counts as a probe """
+        addresses = {}
+        if self.resolver:
+            addresses = await self.resolver.resolve_all([ssl_cert.clean_url(host) for host, port in targets])
+
+        semaphore = self.limiter if self.limiter else asyncio.Semaphore(self.concurrency)
+
+        async def bounded_probe(host, port):
+            host_addresses = addresses.get(ssl_cert.clean_url(host))
+            queued_at = time.time()
+            if self.all_addresses and host_addresses and len(host_addresses) > 1:
+                if self.share:
+                    self.share.enqueue(len(host_addresses))
+                return await self.probe_each_address(host, port, host_addresses, semaphore, queued_at)
+            if self.share:
+                self.share.enqueue()
+            return await self.polite_probe(host, port, host_addresses, semaphore, queued_at)
+
+        return await asyncio.gather(*[bounded_probe(host, port) for host, port in targets])
+
+    def run(self, targets):
+        """ probe a list of (host, port) tuples on a new event loop. results are returned in the order of the targets """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.probe_all(targets))
+        finally:
+            loop.close()
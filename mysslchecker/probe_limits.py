@@ -0,0 +1,223 @@
+import asyncio
+import threading
+import tldextract
+from collections import deque
+
+
+class AIMDLimiter:
+    """ asyncio concurrency limit that adjusts itself with additive increase, multiplicative decrease (as tcp
+    congestion control does). every probe that completes in good time raises the limit by 'increase', up to
+    'max_limit'. a probe that times out, or whose latency is more than 'inflation' times its own host's usual latency
+    (the baseline from latency.LatencyHistory), is taken as a sign of congestion (often on the local machine or network
+    rather than the remote host) and the limit is multiplied by 'decrease', down to 'min_limit'. hosts are only
+    compared with themselves - a far away host is not congested because it is slower than a nearby cdn. hosts with
+    no baseline only signal congestion by timing out. the limit is cut at most once per limit's worth of completed
+    probes, so a burst of timeouts from the same congestion only counts once """
+
+    def __init__(self, min_limit=10, max_limit=500, initial=None, increase=1, decrease=0.7, inflation=3.0):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = float(initial if initial else min_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.inflation = inflation
+        self.in_flight = 0
+        self.completed = 0
+        self.last_decrease = 0  # the completed count when the limit was last cut
+        self._waiters = deque()
+        self.stats = {"limit": int(self.limit), "lowest": int(self.limit), "highest": int(self.limit), "decreases": 0,
+                      "congested": 0}
+
+    async def acquire(self):
+        """ wait for a free slot under the current limit. slots go to the probes in the order they asked for them -
+        a free slot is handed to the waiting probe when it is woken, so a probe arriving in the meantime cannot take
+        it and the longest processing time first order of the targets is kept """
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        self.wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # cancelled after the slot was handed over - pass it on
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        """ hand each free slot to the next waiting probe """
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def resize(self, max_limit, min_limit=None):
+        """ move the limit's bounds, e.g. when the run's share of the probe pool changes (see probe_pool.ProbePool).
+        probes already in flight carry on - new ones wait until the count is under the limit """
+        self.min_limit = min(max_limit, self.min_limit if min_limit is None else min_limit)
+        self.max_limit = max_limit
+        self.limit = float(min(self.max_limit, max(self.min_limit, self.limit)))
+        self.stats["limit"] = int(self.limit)
+        self.stats["lowest"] = min(self.stats["lowest"], int(self.limit))
+        self.stats["highest"] = max(self.stats["highest"], int(self.limit))
+        self.wake()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def record(self, latency=None, timed_out=False, baseline=None):
+        """ adjust the limit from a completed probe. latency is the connect and handshake time if one was measured,
+        baseline the host's usual connect and handshake time if it has a latency history """
+        self.completed += 1
+        congested = timed_out or (latency is not None and baseline is not None and latency > baseline * self.inflation
+                                  and latency > 0.05)  # ignore inflation of very fast handshakes
+        if congested:
+            self.stats["congested"] += 1
+            if self.completed - self.last_decrease >= self.limit:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self.last_decrease = self.completed
+                self.stats["decreases"] += 1
+        else:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+            self.wake()
+
+        self.stats["limit"] = int(self.limit)
+        self.stats["lowest"] = min(self.stats["lowest"], int(self.limit))
+        self.stats["highest"] = max(self.stats["highest"], int(self.limit))
+
+
+# the public suffix list bundled with tldextract - the default extractor may download the list on first use, which
+# would happen in the middle of a probe run
+suffix_list = tldextract.TLDExtract(suffix_list_urls=None)
+
+
+def registrable_domain(hostname):
+    """ the domain a hostname was registered under, using the public suffix list - shop.example.co.uk -> example.co.uk.
+    ip addresses and names without a known suffix are returned as they are """
+    result = suffix_list(hostname)  # https://pypi.org/project/tldextract/2.2.0/
+    if result.domain and result.suffix:
+        return "{0}.{1}".format(result.domain, result.suffix)
+    return hostname
+
+
+class DestinationLimits:
+    """ politeness limits - caps the handshakes in flight to any one ip address ('per_address') and to any one
+    registrable domain ('per_domain'), so a sheet of many subdomains behind the same load balancer does not trigger
+    its rate limiting. a cap of 0 is no limit. probes of other destinations carry on while one is at its cap,
+    so work is interleaved across destinations rather than queued behind the busiest.
+    acquire() and release() are for the asyncio engine, DestinationQueue is the version for threads """
+
+    def __init__(self, per_address=8, per_domain=16):
+        self.per_address = per_address
+        self.per_domain = per_domain
+        self.active = {}  # destination key: probes in flight
+        self._waiters = {}  # destination key: deque of futures waiting for it
+        self.stats = {"waited": 0, "busiest": 0}
+
+    def keys(self, hostname, addresses=None):
+        """ the destinations a probe of the hostname counts against - its registrable domain and each of the
+        addresses given. callers pass the address happy eyeballs tries first (see ssl_cert.first_address) """
+        keys = []
+        if self.per_domain:
+            keys.append(("domain", registrable_domain(hostname)))
+        if self.per_address and addresses:
+            keys.extend(("address", address) for family, address in addresses)
+        return keys
+
+    def cap(self, key):
+        return self.per_domain if key[0] == "domain" else self.per_address
+
+    def blocked(self, keys):
+        """ the first destination in keys that is at its cap, or None """
+        for key in keys:
+            if self.active.get(key, 0) >= self.cap(key):
+                return key
+        return None
+
+    def take(self, keys):
+        for key in keys:
+            self.active[key] = self.active.get(key, 0) + 1
+            self.stats["busiest"] = max(self.stats["busiest"], self.active[key])
+
+    def give(self, keys):
+        for key in keys:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+
+    async def acquire(self, keys):
+        """ wait until none of the destinations are at their cap """
+        waited = False
+        while True:
+            key = self.blocked(keys)
+            if key is None:
+                break
+            waited = True
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.setdefault(key, deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.wake(key)  # pass the wake up on to the next waiter
+                raise
+        self.stats["waited"] += waited
+        self.take(keys)
+
+    def release(self, keys):
+        self.give(keys)
+        for key in keys:
+            self.wake(key)
+
+    def wake(self, key):
+        waiters = self._waiters.get(key)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if not waiters:
+            self._waiters.pop(key, None)
+
+
+class DestinationQueue:
+    """ thread safe queue of targets that only hands out a target when its destinations are under their
+    DestinationLimits caps. get() returns the first such target in queue order, waiting while every queued target is
+    blocked, and None once the queue is empty. call done() when the probe of a target finishes """
+
+    def __init__(self, targets, limits, keys_for):
+        self.limits = limits
+        self.keys_for = keys_for  # function of a target that returns its destination keys (see DestinationLimits.keys)
+        self._queue = [(target, keys_for(target)) for target in targets]
+        self._condition = threading.Condition()
+
+    def get(self):
+        with self._condition:
+            waited = False
+            while self._queue:
+                for index, (target, keys) in enumerate(self._queue):
+                    if self.limits.blocked(keys) is None:
+                        del self._queue[index]
+                        self.limits.take(keys)
+                        self.limits.stats["waited"] += waited
+                        return target
+                waited = True
+                self._condition.wait()
+            return None
+
+    def __len__(self):
+        """ the number of targets not yet handed out """
+        with self._condition:
+            return len(self._queue)
+
+    def done(self, target):
+        with self._condition:
+            self.limits.give(self.keys_for(target))
+            self._condition.notify_all()
@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+import uuid
+from redis.exceptions import RedisError
+
+
+class ProbePool:
+    """ the probes that may run at once across every process ('capacity', SSL_PROBE_POOL_SIZE), shared between the
+    tenants (spreadsheets) with runs in progress in proportion to their weights, so one sheet with thousands of domains
+    cannot hold up the small interactive checks of other users. form runs and the daily run are in different processes,
+    so the runs are kept in redis: each run registers its tenant, weight, queue depth and wait time and refreshes them
+    while it probes, and the entry of a run that dies expires after 'ttl' seconds. a tenant's weight is the highest of
+    its runs' weights and its share is capacity x its weight / the total weight of the tenants in progress, split
+    evenly between its runs (at least 1 each) - so a tenant with weight 4 gets four times the probes of a tenant with
+    weight 1 while both are probing, and a sheet submitted twice does not get two shares. if redis cannot be reached a
+    run has the whole capacity """
+
+    key_prefix = "probe_pool"
+    runs_key = "probe_pool:runs"  # set of the runs that have registered
+
+    def __init__(self, connection, capacity=None, ttl=15, interval=1):
+        self.connection = connection  # redis connection (see worker.conn)
+        self.capacity = capacity if capacity else int(os.getenv("SSL_PROBE_POOL_SIZE", 500))
+        self.ttl = ttl  # seconds before the entry of a run that stopped refreshing it is dropped
+        self.interval = interval  # seconds between refreshes of a run's entry and share
+
+    def key(self, run_id):
+        return "{0}:run:{1}".format(self.key_prefix, run_id)
+
+    def share(self, run_id, tenant, weight, queued=0, wait=None):
+        """ register (or refresh) the run with its number of queued probes and mean wait for a slot (seconds), and
+        return its share of the capacity and a dictionary of tenant: {"weight", "runs", "queued", "wait"} for every
+        tenant in progress. wait is the mean over the tenant's runs, None until one of its probes has started """
+        entry = {"tenant": tenant, "weight": weight, "queued": queued, "wait": wait}
+        try:
+            pipeline = self.connection.pipeline(transaction=False)
+            pipeline.set(self.key(run_id), json.dumps(entry), ex=self.ttl)
+            pipeline.sadd(self.runs_key, run_id)
+            pipeline.smembers(self.runs_key)
+            runs = [run.decode() if isinstance(run, bytes) else run for run in pipeline.execute()[2]]
+            entries = self.connection.mget([self.key(run) for run in runs])
+            expired = [run for run, run_entry in zip(runs, entries) if run_entry is None]
+            if expired:
+                self.connection.srem(self.runs_key, *expired)
+        except RedisError as err:
+            print("probe pool unavailable: {0}".format(err))
+            return self.capacity, {tenant: {"weight": weight, "runs": 1, "queued": queued, "wait": wait}}
+
+        tenants = {}
+        for run_entry in entries:
+            if run_entry is None:
+                continue
+            run_entry = json.loads(run_entry)
+            totals = tenants.setdefault(run_entry["tenant"], {"weight": 0, "runs": 0, "queued": 0, "wait": None})
+            totals["weight"] = max(totals["weight"], float(run_entry["weight"]))
+            totals["runs"] += 1
+            totals["queued"] += run_entry["queued"]
+            if run_entry["wait"] is not None:
+                totals["waits"] = totals.get("waits", []) + [run_entry["wait"]]
+        for totals in tenants.values():
+            waits = totals.pop("waits", None)
+            totals["wait"] = round(sum(waits) / len(waits), 2) if waits else None
+
+        total = sum(totals["weight"] for totals in tenants.values())
+        own = tenants.get(tenant)
+        if not total or not own:
+            return self.capacity, tenants
+        return max(1, int(self.capacity * own["weight"] / total / own["runs"])), tenants
+
+    def leave(self, run_id):
+        try:
+            pipeline = self.connection.pipeline(transaction=False)
+            pipeline.delete(self.key(run_id))
+            pipeline.srem(self.runs_key, run_id)
+            pipeline.execute()
+        except RedisError as err:
+            print("unable to leave the probe pool: {0}".format(err))
+
+    def join(self, tenant, weight):
+        """ a ProbeShare for a run of the tenant (spreadsheet id) with the weight """
+        return ProbeShare(self, tenant, uuid.uuid4().hex, weight)
+
+
+class ProbeShare:
+    """ a run's place in the ProbePool. use it as a context manager around the probing - a background thread refreshes
+    the run's entry every 'interval' seconds and keeps 'limit' at the run's current share. the probe engines keep the
+    probes in flight within 'limit', call enqueue() for the probes waiting to start and started() as each one gets a
+    slot, so the run's queue depth and wait time are published with its entry. 'stats' has the run's own figures and,
+    under "tenants", those of every tenant in progress at the last refresh """
+
+    def __init__(self, pool, tenant, run_id, weight):
+        self.pool = pool
+        self.tenant = tenant
+        self.run_id = "{0}:{1}".format(tenant, run_id)
+        self.weight = max(1, int(weight))
+        self.limit = pool.capacity
+        self.queued = 0  # probes waiting for a slot
+        self.waits = []  # seconds each started probe waited for its slot
+        self.stats = {"tenant": tenant, "weight": self.weight, "lowest": None, "highest": None, "queued": 0,
+                      "started": 0, "wait_mean": None, "wait_max": None, "tenants": {}}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        self.refresh()
+        thread = threading.Thread(target=self.heartbeat, name="probe pool {0}".format(self.run_id))
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stopped.set()
+        self.refresh()  # the run's final queue depth and wait time, and the other tenants' at the end of the run
+        self.pool.leave(self.run_id)
+
+    def enqueue(self, count=1):
+        """ count more probes are waiting for a slot """
+        with self._lock:
+            self.queued += count
+
+    def started(self, queued_at):
+        """ a queued probe got its slot. queued_at is the time.time() it was queued at """
+        with self._lock:
+            self.queued -= 1
+            self.waits.append(time.time() - queued_at)
+
+    def wait_mean(self):
+        with self._lock:
+            return round(sum(self.waits) / len(self.waits), 2) if self.waits else None
+
+    def update_stats(self):
+        with self._lock:
+            self.stats["queued"] = self.queued
+            self.stats["started"] = len(self.waits)
+            self.stats["wait_max"] = round(max(self.waits), 2) if self.waits else None
+        self.stats["wait_mean"] = self.wait_mean()
+
+    def refresh(self):
+        self.limit, self.stats["tenants"] = self.pool.share(self.run_id, self.tenant, self.weight, self.queued,
+                                                            self.wait_mean())
+        self.stats["lowest"] = self.limit if self.stats["lowest"] is None else min(self.stats["lowest"], self.limit)
+        self.stats["highest"] = self.limit if self.stats["highest"] is None else max(self.stats["highest"], self.limit)
+        self.update_stats()
+
+    def heartbeat(self):
+        while not self._stopped.wait(self.pool.interval):
+            self.refresh()
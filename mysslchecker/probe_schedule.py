@@ -0,0 +1,97 @@
+import json
+import time
+from redis.exceptions import RedisError
+from probe_cache import ProbeCache
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
+
+class ProbeSchedule:
+    """ keeps the last site object probed for each (host, port) in redis, with the time it is next due to be checked.
+    the check interval depends on how close the certificate is to expiry:
+    - far_interval - certificates with more than 'near_window' left (weekly)
+    - near_interval - certificates inside 'near_window' (daily)
+    - urgent_interval - certificates inside 'urgent_window', failing or missing certificates (hourly)
+
+    scheduled runs (daily run and the refresh link) only probe the domains that are due and reuse the stored site for
+    the rest. if redis cannot be reached every domain is treated as due """
+
+    key_prefix = "probe_schedule"
+
+    def __init__(self, connection, far_interval=WEEK, near_interval=DAY, urgent_interval=HOUR, near_window=30 * DAY,
+                 urgent_window=2 * DAY, retention=5 * WEEK):
+        self.connection = connection  # redis connection (see worker.conn)
+        self.far_interval = far_interval
+        self.near_interval = near_interval
+        self.urgent_interval = urgent_interval
+        self.near_window = near_window
+        self.urgent_window = urgent_window
+        self.retention = retention  # stored sites are dropped if they have not been checked for this long
+        self.stats = {"due": 0, "reused": 0}
+
+    def key(self, hostname, port, forgiving):
+        """ forgiving mode can return a different certificate (from a redirect) so is stored separately. the hostname
+        is normalised as the probe cache and backoff keys are """
+        return "{0}:{1}:{2}:{3}".format(self.key_prefix, ProbeCache.normalise(hostname), port or 443,
+                                        "forgiving" if forgiving else "strict")
+
+    @staticmethod
+    def is_failing(site):
+        """ matches the 'missing' and 'fail' statuses of conversions.get_sorted_categories() """
+        return "expiry" not in site or ("error" in site and "PASS" not in site["error"])
+
+    def next_check(self, site, now=None):
+        """ returns the timestamp the site is next due to be probed. a check is never scheduled later than the time the
+        certificate moves into a shorter interval """
+        now = now if now else time.time()
+        if self.is_failing(site):
+            return now + self.urgent_interval
+
+        remaining = site["expiry"] - now
+        if remaining < self.urgent_window:
+            return now + self.urgent_interval
+        elif remaining < self.near_window:
+            return min(now + self.near_interval, site["expiry"] - self.urgent_window)
+        else:
+            return min(now + self.far_interval, site["expiry"] - self.near_window)
+
+    def split_due(self, targets, forgiving, now=None):
+        """ returns a tuple of the (url, port) targets that are due to be probed, and a dictionary of target: stored
+        site for the targets that are not """
+        now = now if now else time.time()
+        if not targets:
+            return [], {}
+
+        try:
+            entries = self.connection.mget([self.key(url, port or 443, forgiving) for url, port in targets])
+        except RedisError as err:
+            print("probe schedule unavailable, probing every domain: {0}".format(err))
+            self.stats["due"] += len(targets)
+            return list(targets), {}
+
+        due = []
+        stored_sites = {}
+        for target, entry in zip(targets, entries):
+            entry = json.loads(entry) if entry else None
+            if entry and entry["next_check"] > now:
+                stored_sites[target] = entry["site"]
+            else:
+                due.append(target)
+
+        self.stats["due"] += len(due)
+        self.stats["reused"] += len(stored_sites)
+        return due, stored_sites
+
+    def store(self, site_targets, forgiving, now=None):
+        """ store the site object for each probed ((url, port), site) pair with its next check time """
+        now = now if now else time.time()
+        try:
+            pipeline = self.connection.pipeline(transaction=False)
+            for (url, port), site in site_targets:
+                entry = {"site": site, "checked": now, "next_check": self.next_check(site, now)}
+                pipeline.set(self.key(url, port or 443, forgiving), json.dumps(entry), ex=self.retention)
+            pipeline.execute()
+        except RedisError as err:
+            print("unable to update the probe schedule: {0}".format(err))
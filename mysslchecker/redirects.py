@@ -0,0 +1,110 @@
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urljoin, urlparse
+from redis.exceptions import RedisError
+from ssl_contexts import registry
+
+MAX_HOPS = 5  # redirects followed before giving up and using the last host seen
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class RedirectCache:
+    """ cache of hostname: final hostname after following the redirects from http://hostname. redirects rarely change so
+    entries are kept for 'ttl' seconds. entries are held in the process and, once a redis connection is set, in redis
+    as well so that they are shared between runs """
+
+    key_prefix = "redirect"
+
+    def __init__(self, ttl=24 * 60 * 60, max_entries=50000, connection=None):
+        self._lock = threading.Lock()
+        self._entries = {}  # hostname: (expires_at, final hostname)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connection = connection  # redis connection (see worker.conn)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, hostname):
+        """ returns the final hostname, or None if the hostname is not cached """
+        with self._lock:
+            entry = self._entries.get(hostname)
+            if entry and entry[0] > time.time():
+                self.stats["hits"] += 1
+                return entry[1]
+
+        final_hostname = None
+        if self.connection:
+            try:
+                stored = self.connection.get("{0}:{1}".format(self.key_prefix, hostname))
+                final_hostname = json.loads(stored) if stored else None
+            except RedisError as err:
+                print("redirect cache unavailable: {0}".format(err))
+
+        with self._lock:
+            if final_hostname:
+                self.stats["hits"] += 1
+                self._entries[hostname] = (time.time() + self.ttl, final_hostname)
+            else:
+                self.stats["misses"] += 1
+        return final_hostname
+
+    def set(self, hostname, final_hostname):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.time()
+                self._entries = {name: entry for name, entry in self._entries.items() if entry[0] > now}
+            self._entries[hostname] = (time.time() + self.ttl, final_hostname)
+
+        if self.connection:
+            try:
+                self.connection.set("{0}:{1}".format(self.key_prefix, hostname), json.dumps(final_hostname), ex=self.ttl)
+            except RedisError as err:
+                print("unable to update the redirect cache: {0}".format(err))
+
+
+cache = RedirectCache()
+
+
+def request_headers(url, timeout):
+    """ returns the (status, location header) for the url. a HEAD request is sent, falling back to a GET for servers
+    that do not allow HEAD. only the response headers are read, never the body.
+    https hops are not verified - only the location is needed, the redirected domain's certificate is probed later """
+    parsed_url = urlparse(url)
+    path = (parsed_url.path or "/") + ("?" + parsed_url.query if parsed_url.query else "")
+
+    for method in ("HEAD", "GET"):
+        if parsed_url.scheme == "https":
+            connection = http.client.HTTPSConnection(parsed_url.hostname, parsed_url.port, timeout=timeout,
+                                                     context=registry.get_context("unverified"))
+        else:
+            connection = http.client.HTTPConnection(parsed_url.hostname, parsed_url.port, timeout=timeout)
+        try:
+            connection.request(method, path)
+            response = connection.getresponse()  # reads the status line and headers only
+            if method == "HEAD" and response.status in (405, 501):
+                continue  # HEAD not allowed
+            return response.status, response.getheader("Location")
+        finally:
+            connection.close()  # closes the socket without reading the body
+
+
+def follow_redirects(hostname, timeout, max_hops=MAX_HOPS):
+    """ returns the hostname that http://hostname finally redirects to (the hostname itself if there is no redirect) """
+    url = "http://{0}/".format(hostname)
+    for hop in range(max_hops):
+        status, location = request_headers(url, timeout)
+        if status not in REDIRECT_STATUSES or not location:
+            break
+        url = urljoin(url, location)
+    return urlparse(url).hostname or hostname
+
+
+def resolve_redirect(hostname, timeout, redirect_cache=None):
+    """ follow_redirects() through the redirect cache. errors (e.g. socket.timeout) are raised and not cached """
+    redirect_cache = redirect_cache if redirect_cache else cache
+    final_hostname = redirect_cache.get(hostname)
+    if final_hostname is None:
+        final_hostname = follow_redirects(hostname, timeout)
+        redirect_cache.set(hostname, final_hostname)
+    return final_hostname
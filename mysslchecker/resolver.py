@@ -0,0 +1,149 @@
+import asyncio
+import socket
+import threading
+import time
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+
+
+class ResolverCache:
+    """ process-wide cache of dns answers. entries expire with the ttl of the dns records, failed lookups are kept for
+    the (shorter) negative ttl so dead hosts are not looked up again on every run """
+
+    def __init__(self, max_entries=50000):
+        self._lock = threading.Lock()
+        self._entries = {}  # hostname: (expires_at, addresses). an empty address list is a negative entry
+        self.max_entries = max_entries
+
+    def get(self, hostname):
+        """ returns the cached list of (family, address) tuples, an empty list for a cached failure, or None if the
+        hostname is not cached or has expired """
+        with self._lock:
+            entry = self._entries.get(hostname)
+            if entry is None:
+                return None
+            expires_at, addresses = entry
+            if expires_at <= time.time():
+                del self._entries[hostname]
+                return None
+            return addresses
+
+    def set(self, hostname, addresses, ttl):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self.remove_expired()
+            self._entries[hostname] = (time.time() + ttl, addresses)
+
+    def remove_expired(self):
+        """ drops expired entries. the lock must be held by the caller """
+        now = time.time()
+        for hostname in [hostname for hostname, entry in self._entries.items() if entry[0] <= now]:
+            del self._entries[hostname]
+
+
+cache = ResolverCache()
+
+
+class Resolver:
+    """ resolves a list of hostnames concurrently before probing starts. A and AAAA records are looked up with
+    dnspython so their ttl can be respected. names that dns does not answer for (e.g. hosts file entries) fall back to
+    the system resolver with the default ttl """
+
+    def __init__(self, timeout=5, min_ttl=30, max_ttl=3600, default_ttl=300, negative_ttl=60, concurrency=200,
+                 resolver_cache=None):
+        self.timeout = timeout
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.default_ttl = default_ttl  # used when the ttl is not known (system resolver)
+        self.negative_ttl = negative_ttl
+        self.concurrency = concurrency  # max number of lookups in flight
+        self.cache = resolver_cache if resolver_cache else cache
+        self.stats = {"hosts": 0, "cache_hits": 0, "negative_hits": 0, "lookups": 0, "failed": 0, "elapsed": 0.0}
+        self.lookup_times = {}  # hostname: seconds spent resolving during this run (0 for a cache hit)
+        try:
+            self.dns_resolver = dns.asyncresolver.Resolver()
+        except dns.resolver.NoResolverConfiguration:
+            self.dns_resolver = None  # no nameservers configured, only the system resolver is used
+
+    def clamp_ttl(self, ttl):
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    async def query_dns(self, hostname):
+        """ returns a tuple of the (family, address) list from the A and AAAA records, and the lowest ttl """
+        if not self.dns_resolver:
+            return [], None
+
+        async def query(record_type, family):
+            try:
+                answer = await self.dns_resolver.resolve(hostname, record_type, lifetime=self.timeout)
+                return [(family, record.address) for record in answer], answer.rrset.ttl
+            except (dns.exception.DNSException, ValueError, UnicodeError):
+                return [], None  # includes names dns cannot hold (e.g. a label over 63 characters) - cached as a failure
+
+        answers = await asyncio.gather(query("A", socket.AF_INET), query("AAAA", socket.AF_INET6))
+        addresses = [address for record_addresses, ttl in answers for address in record_addresses]
+        ttls = [ttl for record_addresses, ttl in answers if ttl is not None]
+        return addresses, (min(ttls) if ttls else None)
+
+    async def query_system(self, hostname):
+        """ returns the (family, address) list from getaddrinfo - the resolver used by socket.create_connection() """
+        loop = asyncio.get_event_loop()
+        try:
+            info = await asyncio.wait_for(loop.getaddrinfo(hostname, None, type=socket.SOCK_STREAM), self.timeout)
+        except (OSError, UnicodeError, asyncio.TimeoutError):
+            return []
+        addresses = []
+        for family, _, _, _, sockaddr in info:
+            if (family, sockaddr[0]) not in addresses:
+                addresses.append((family, sockaddr[0]))
+        return addresses
+
+    async def resolve(self, hostname):
+        """ returns the list of (family, address) tuples for the hostname, using the cache where possible """
+        addresses = self.cache.get(hostname)
+        if addresses is not None:
+            self.stats["cache_hits"] += 1
+            if not addresses:
+                self.stats["negative_hits"] += 1
+            self.lookup_times[hostname] = 0.0
+            return addresses
+
+        started = time.time()
+        self.stats["lookups"] += 1
+        addresses, ttl = await self.query_dns(hostname)
+        if not addresses:
+            addresses = await self.query_system(hostname)
+            ttl = self.default_ttl
+
+        if addresses:
+            self.cache.set(hostname, addresses, self.clamp_ttl(ttl))
+        else:
+            self.stats["failed"] += 1
+            self.cache.set(hostname, addresses, self.negative_ttl)
+
+        self.lookup_times[hostname] = time.time() - started
+        return addresses
+
+    async def resolve_all(self, hostnames):
+        """ resolves the deduplicated hostnames concurrently. returns a dictionary of hostname: (family, address) list """
+        started = time.time()
+        unique_hostnames = list(dict.fromkeys(hostnames))  # dedupe, keeping the order
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded_resolve(hostname):
+            async with semaphore:
+                return await self.resolve(hostname)
+
+        results = await asyncio.gather(*[bounded_resolve(hostname) for hostname in unique_hostnames])
+        self.stats["hosts"] += len(unique_hostnames)
+        self.stats["elapsed"] += time.time() - started
+        return dict(zip(unique_hostnames, results))
+
+    def run(self, hostnames):
+        """ resolve the hostnames on a new event loop - for callers that are not already running one """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.resolve_all(hostnames))
+        finally:
+            loop.close()
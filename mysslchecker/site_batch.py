@@ -0,0 +1,219 @@
+import sys
+import time
+from collections.abc import Mapping
+from datetime import datetime
+from dateutil import relativedelta
+import numpy as np
+from ssl_cert import countdown_for_days
+
+ABSENT = np.iinfo(np.int64).min  # marks a missing date in the int64 date columns
+STATUSES = ("missing", "fail", "pass")  # ssl_status values, stored as their index
+CATEGORIES = ("expired", "one_day", "two_day", "one_wk", "two_wk", "one_mth", "two_mth", "three_mth", "six_mth",
+              "six_plus")  # highest priority first, as conversions.categorise_sites()
+TEXT_FIELDS = ("name", "issuer", "number", "countdown", "error")
+INTERNED_FIELDS = ("name", "issuer", "countdown")  # values shared by many sites
+
+
+class SiteBatch:
+    """ columnar store of the site objects from a run. the expiry and start dates are int64 epoch arrays, ssl_status is
+    a small int array and the repeated strings (subject name, issuer, countdown) are interned, so a sheet with tens of
+    thousands of domains does not hold a dictionary per site. categorisation, sorting and the dashboard rows work
+    on the columns. SiteView gives read only dictionary access to a site for the code that expects site objects """
+
+    def __init__(self, size=0):
+        self.size = size
+        self.urls = [None] * size
+        self.expiry = np.full(size, ABSENT, dtype=np.int64)
+        self.start = np.full(size, ABSENT, dtype=np.int64)
+        self.checked = np.full(size, np.nan)  # float64 - the probe time keeps its fraction of a second
+        self.status = np.zeros(size, dtype=np.int8)
+        self.text = {field: [None] * size for field in TEXT_FIELDS}
+        self.extras = [None] * size  # a dictionary of any other site keys (e.g. "cached", "fingerprint"), or None
+        self.category = np.zeros(size, dtype=np.int8)
+        self.order = np.arange(size)  # site indexes in sorted order
+
+    @staticmethod
+    def site_status(site):
+        """ the ssl_status of a site object (see conversions.get_sorted_categories). a site with a nan expiry has no
+        certificate date, so is missing """
+        if "expiry" not in site or not np.isfinite(site["expiry"]):
+            return 0  # missing
+        elif "error" in site and "PASS" not in site["error"]:  # fail if it doesn't include pass
+            return 1  # fail
+        return 2  # pass if it does include pass or has no errors
+
+    @classmethod
+    def from_sites(cls, site_list):
+        """ a batch of the site objects, in the order given. an expiry or start date that is not a finite number
+        (e.g. nan) is kept as a missing date """
+        batch = cls(len(site_list))
+        for index, site in enumerate(site_list):
+            extras = None
+            for key, value in site.items():
+                if key == "url":
+                    batch.urls[index] = value
+                elif key == "expiry" or key == "start":
+                    if np.isfinite(value):
+                        getattr(batch, key)[index] = value
+                elif key == "checked":
+                    batch.checked[index] = value
+                elif key in INTERNED_FIELDS and isinstance(value, str):
+                    batch.text[key][index] = sys.intern(value)
+                elif key in batch.text:
+                    batch.text[key][index] = value
+                elif key != "ssl_status":
+                    extras = extras if extras else {}
+                    extras[key] = value
+            batch.extras[index] = extras
+            batch.status[index] = cls.site_status(site)
+        return batch
+
+    @classmethod
+    def from_categories(cls, categorised):
+        """ a batch of an already categorised dictionary of category: site list, keeping its categories and order """
+        batch = cls.from_sites([site for category in categorised for site in categorised[category]])
+        batch.category = np.array([CATEGORIES.index(category) for category in categorised
+                                   for site in categorised[category]], dtype=np.int8)
+        return batch
+
+    def value(self, index, key):
+        """ the site object value for the key. raises KeyError if the site does not have the key """
+        if key == "url":
+            return self.urls[index]
+        elif key == "expiry" or key == "start":
+            value = getattr(self, key)[index]
+            if value == ABSENT:
+                raise KeyError(key)
+            return float(value)
+        elif key == "checked":
+            if np.isnan(self.checked[index]):
+                raise KeyError(key)
+            return float(self.checked[index])
+        elif key == "ssl_status":
+            return STATUSES[self.status[index]]
+        elif key in self.text:
+            value = self.text[key][index]
+            if value is None:
+                raise KeyError(key)
+            return value
+        elif self.extras[index] and key in self.extras[index]:
+            return self.extras[index][key]
+        raise KeyError(key)
+
+    def keys(self, index):
+        """ the keys of the site object """
+        keys = ["url"] if self.urls[index] is not None else []
+        keys.extend(key for key in ("expiry", "start") if getattr(self, key)[index] != ABSENT)
+        keys.extend(key for key in TEXT_FIELDS if self.text[key][index] is not None)
+        if not np.isnan(self.checked[index]):
+            keys.append("checked")
+        keys.append("ssl_status")
+        if self.extras[index]:
+            keys.extend(self.extras[index])
+        return keys
+
+    @staticmethod
+    def boundaries(time_now=None):
+        """ the epochs at which a site moves from one category to the next (see conversions.categorise_sites),
+        calculated once per categorisation rather than per site """
+        time_now = time_now if time_now else datetime.now()
+        return np.array([(time_now + relativedelta.relativedelta(**delta)).timestamp() for delta in (
+            {}, {"days": +1}, {"days": +2}, {"weeks": +1}, {"weeks": +2}, {"months": +1}, {"months": +2},
+            {"months": +3}, {"months": +6})])
+
+    def categorise(self, time_now=None):
+        """ place each site in a category according to the time until it expires and sort the sites, in one pass over
+        the columns. sites with no certificate or that fail are placed in expired. the sorted order is sites with no
+        certificate then failing sites, each sorted by url, then passing sites sorted by expiry - as the categories are
+        ranges of expiry this also groups the sites by category """
+        passing = self.status == 2
+        category = np.searchsorted(self.boundaries(time_now), self.expiry, side="right")  # boundaries <= expiry
+        self.category = np.where(passing, category, 0).astype(np.int8)
+
+        rank = np.zeros(self.size, dtype=np.int64)  # url order of the sites that are not passing
+        others = np.flatnonzero(~passing)
+        urls = np.array([self.urls[index] for index in others], dtype=object)
+        rank[others[np.argsort(urls, kind="stable")]] = np.arange(len(others))
+        self.order = np.lexsort((np.where(passing, self.expiry, rank), self.status))  # stable, as sorted()
+
+    def countdowns(self, time_now=None):
+        """ set the countdown of every site with an expiry date from the expiry column. called when the dashboard and
+        email are written, so stored, cached and queued results show the time left now. each distinct expiry day is
+        formatted once (see ssl_cert.countdown_for_days) """
+        now_day = int((time_now if time_now else time.time()) // 86400)
+        has_expiry = self.expiry != ABSENT
+        days, positions = np.unique(self.expiry[has_expiry] // 86400, return_inverse=True)
+        countdowns = [countdown_for_days(day, now_day) for day in days.tolist()]
+        column = self.text["countdown"]
+        for index, position in zip(np.flatnonzero(has_expiry).tolist(), positions.tolist()):
+            column[index] = countdowns[position]
+
+    def categories(self):
+        """ dictionary of category: list of SiteView in sorted order - the structure returned by
+        conversions.get_sorted_categories() """
+        categorised = {category: [] for category in CATEGORIES}
+        category = self.category.tolist()
+        for index in self.order.tolist():
+            categorised[CATEGORIES[category[index]]].append(SiteView(self, index))
+        return categorised
+
+    def column(self, key):
+        """ the values of a site key as a list, None where a site does not have the key """
+        if key == "url":
+            return self.urls
+        elif key == "expiry" or key == "start":
+            return [None if value == ABSENT else float(value) for value in getattr(self, key).tolist()]
+        elif key == "checked":
+            return [None if value != value else value for value in self.checked.tolist()]  # nan is not equal to itself
+        elif key == "ssl_status":
+            return [STATUSES[status] for status in self.status.tolist()]
+        elif key in self.text:
+            return self.text[key]
+        return [extras.get(key) if extras else None for extras in self.extras]
+
+    def date_column(self, key, convert):
+        """ the expiry, start or checked dates converted by convert(), a function of an array of timestamps (e.g.
+        GoogleSheet.serial_dates), as a list with None where a site does not have the date """
+        values = self.checked if key == "checked" else np.where(getattr(self, key) == ABSENT, np.nan, getattr(self, key))
+        converted = convert(values)
+        return [None if value != value else value for value in converted.tolist()]  # nan is not equal to itself
+
+    def rows(self, site_keys, dates=None):
+        """ the dashboard rows in sorted order (which is grouped by category), with the values in the order of
+        site_keys. passing sites show "None" for missing values. other sites show a message in place of the countdown.
+        if given, dates converts the date columns (see date_column) """
+        columns = [(key, self.date_column(key, dates) if dates and key in ("expiry", "start", "checked")
+                    else self.column(key)) for key in site_keys]
+        status = self.status.tolist()
+        messages = {0: "** SSL certificate not found **", 1: "** Invalid SSL **"}
+        rows = []
+        for index in self.order.tolist():
+            if status[index] == 2:
+                row = ["None" if column[index] is None else column[index] for key, column in columns]
+            else:
+                row = [messages[status[index]] if key == "countdown" else "" if column[index] is None else column[index]
+                       for key, column in columns]
+            rows.append(row)
+        return rows
+
+
+class SiteView(Mapping):
+    """ read only dictionary view of a site in a SiteBatch """
+
+    __slots__ = ("batch", "index")
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.batch.value(self.index, key)
+
+    def __iter__(self):
+        return iter(self.batch.keys(self.index))
+
+    def __len__(self):
+        return len(self.batch.keys(self.index))
+
+    def __repr__(self):
+        return repr(dict(self))
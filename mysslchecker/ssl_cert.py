@@ -2,32 +2,119 @@
 
 import sys
 import ssl
-from OpenSSL import crypto
-from datetime import datetime, timezone
+from OpenSSL import crypto, SSL
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+import ipaddress
+from datetime import datetime, timezone, date, timedelta
 import pytz
 import getopt
 import socket
 from dateutil import relativedelta
 import re
-from urllib.request import urlopen
-from urllib.parse import urlparse
-import urllib.error
+import http.client
 import json
+import time
+import os
+import errno
+import selectors
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ssl_contexts import registry
+import redirects
+import resolver
 
 class Certificate:
-    """ creates a certificate object, providing formatted access to the main certificate properties """
-
-    def __init__(self, cert):
-
-        self._x509 = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
-        self.expiry = self.get_expiry()
-        self.issuer = self.get_issuer()
+    """ creates a certificate object, providing formatted access to the main certificate properties.
+    the der certificate is parsed once with cryptography's x509 api: the dates are kept as epoch timestamps and the
+    names as tuples of (short name, value) components. the formatted properties (expiry, start, issuer, serial,
+    countdown, subject_org) are worked out the first time they are read. the parsed certificate is not kept """
+
+    __slots__ = ("readable", "local", "offset", "issuer_short", "expiry_epoch", "start_epoch", "serial_number",
+                 "issuer_components", "subject_components", "subject", "url", "_expiry", "_start", "_issuer",
+                 "_serial", "_countdown", "_subject_org")
+
+    # short names of the name attributes (as openssl gives them) - other attributes use cryptography's name for the oid
+    short_names = {
+        x509.NameOID.COUNTRY_NAME: "C",
+        x509.NameOID.STATE_OR_PROVINCE_NAME: "ST",
+        x509.NameOID.LOCALITY_NAME: "L",
+        x509.NameOID.ORGANIZATION_NAME: "O",
+        x509.NameOID.ORGANIZATIONAL_UNIT_NAME: "OU",
+        x509.NameOID.COMMON_NAME: "CN"
+    }
+
+    def __init__(self, cert, readable=False, local=False, offset=None, issuer_short=False):
+        """ cert is the der certificate bytes, or a pem string """
+
+        self.readable = readable
+        self.local = local
+        self.offset = offset
+        self.issuer_short = issuer_short
+        if isinstance(cert, str):
+            cert = ssl.PEM_cert_to_DER_cert(cert)
+        x509_cert = x509.load_der_x509_certificate(cert, default_backend())
+        self.expiry_epoch = self.utc_timestamp(x509_cert, "not_valid_after")
+        self.start_epoch = self.utc_timestamp(x509_cert, "not_valid_before")
+        self.serial_number = x509_cert.serial_number
+        self.issuer_components = self.decode_components(x509_cert.issuer)
+        self.subject_components = self.decode_components(x509_cert.subject)
         self.subject = None  # to add
-        self.serial = self.get_serial()
-        self.start = self.get_start()
         self.url = None
-        self.countdown = self.get_countdown()
-        self.subject_org = self.get_organisation("subject")
+        self._expiry = self._start = self._issuer = self._serial = self._countdown = self._subject_org = None
+
+    @staticmethod
+    def utc_timestamp(x509_cert, date_property):
+        """ epoch timestamp of a certificate date. newer versions of cryptography return aware datetimes from the
+        "_utc" properties, older versions only have the naive utc datetimes """
+        utc_date = getattr(x509_cert, date_property + "_utc", None)
+        if utc_date is None:
+            utc_date = getattr(x509_cert, date_property).replace(tzinfo=timezone.utc)
+        return utc_date.timestamp()
+
+    @classmethod
+    def decode_components(cls, name):
+        """ converts a cryptography x509.Name to a tuple of (short name, value) tuples in certificate order """
+        return tuple((cls.short_names.get(attribute.oid, attribute.oid._name), attribute.value) for attribute in name)
+
+    @property
+    def expiry(self):
+        if self._expiry is None:
+            self._expiry = self.get_expiry()
+        return self._expiry
+
+    @property
+    def start(self):
+        if self._start is None:
+            self._start = self.get_start()
+        return self._start
+
+    @property
+    def issuer(self):
+        if self._issuer is None:
+            self._issuer = self.get_issuer()
+        return self._issuer
+
+    @property
+    def serial(self):
+        if self._serial is None:
+            self._serial = self.get_serial()
+        return self._serial
+
+    @property
+    def countdown(self):
+        if self._countdown is None:
+            self._countdown = self.get_countdown()
+        return self._countdown
+
+    @property
+    def subject_org(self):
+        if self._subject_org is None:
+            self._subject_org = self.get_organisation("subject")
+        return self._subject_org
 
     def get_expiry(self):
         """ formats the expiry expiry datetime object """
@@ -36,38 +123,28 @@ class Certificate:
         return formatted_date
 
     def ssl_property_to_py(self, x509_property):
-        """ returns an x509 date a datetime object """
+        """ returns an x509 date as a datetime object, a name as a list of (property, value) tuples or the serial as
+        an integer """
         if x509_property == "start":
-            x509_date = self._x509.get_notBefore().decode('utf-8')
-            py_date = self.convert_x509_to_dt(x509_date)
-            return py_date
+            return datetime.fromtimestamp(self.start_epoch, timezone.utc)
         elif x509_property == "expiry":
-            x509_date = self._x509.get_notAfter().decode('utf-8')
-            py_date = self.convert_x509_to_dt(x509_date)
-            return py_date
+            return datetime.fromtimestamp(self.expiry_epoch, timezone.utc)
         elif x509_property == "issuer":
-            binary_issuer = self._x509.get_issuer().get_components()  # returns a tuple of issuer components in binary
-            utf8_issuer = [(prop.decode('utf-8'), value.decode('utf-8')) for prop, value in binary_issuer]  # List Comp > Converts binary tuple to utf-8
-            return utf8_issuer
+            return list(self.issuer_components)
         elif x509_property == "serial":
-            serial_number = self._x509.get_serial_number()  # returns an integer (see get_serial() for hexcode)
-            return serial_number
+            return self.serial_number  # an integer (see get_serial() for hexcode)
         elif x509_property == "subject":
-            binary_issuer = self._x509.get_subject().get_components()  # returns a tuple of issuer components in binary
-            utf8_issuer = [(prop.decode('utf-8'), value.decode('utf-8')) for prop, value in binary_issuer]  # List Comp > Converts binary tuple to utf-8
-            return utf8_issuer
+            return list(self.subject_components)
 
         else:
             raise Exception("x509 property not recognised: {0}".format(x509_property))
 
     def get_issuer(self):
         """ returns formatted string """
-        issuer_tuple = self.ssl_property_to_py("issuer")
-        formatted_issuer = self.format_issuer(issuer_tuple)
-        return formatted_issuer
+        return self.format_issuer(self.issuer_components, self.issuer_short)
 
     @staticmethod
-    def format_issuer(components):
+    def format_issuer(components, issuer_short=False):
         """ formats the decoded component tuple. Creates a single string with each tuple pair ', ' separated.
         Converts issuer codes to full names e.g 'C' to 'Country'. Inserts a character between each key and value
         such as '=' or ':' to aid string readability. Has the option to return a dictionary rather than a
@@ -98,8 +175,7 @@ class Certificate:
         return issuer_string  # e.g. Country=GB, State=Greater Manchester, Location=Salford, Organisation=COMODO CA Limited
 
     def get_serial(self):
-        serial_number = self.ssl_property_to_py("serial")
-        hex_number = format(serial_number, 'x')  # get_serial_number returns integer but hex format is more common to see on internet
+        hex_number = format(self.serial_number, 'x')  # get_serial_number returns integer but hex format is more common to see on internet
         return hex_number
 
     def get_start(self):
@@ -119,7 +195,7 @@ class Certificate:
         """ takes the requested offset number and returns the offset number required for Etc/GMT as a string
         note the number required for Etc/GMT offset is the *inverse* of normal offsets due to a POSIX bug
         """
-        if offset:
+        if off_amount:
             offset_int = int(off_amount)
             if offset_int in range(0, -14):
                 offset_string = "+{0}".format(offset_int)
@@ -131,18 +207,18 @@ class Certificate:
             return offset_string
 
         else:
-            return offset  # return the existing None value
+            return off_amount  # return the existing None value
 
     def format_date(self, python_date):
         """ format the python date for readability. return a timestamp by default.
         if offset and local provided, offset will be returned """
         date = python_date
-        if local and not offset:
+        if self.local and not self.offset:
             date = python_date.astimezone(pytz.timezone("Europe/London"))
-        if offset:
-            offset_string = self.format_gmt_offset(offset)
+        if self.offset:
+            offset_string = self.format_gmt_offset(self.offset)
             date = python_date.astimezone(pytz.timezone("Etc/GMT{0}".format(offset_string)))
-        if readable:
+        if self.readable:
             human_format = "%c"  # Locale’s appropriate date and time representation: Tue Aug 16 21:30:00 1988 (en_US);
             date = date.strftime(human_format)
         else:
@@ -151,26 +227,7 @@ class Certificate:
 
     def get_countdown(self):
         """ return the time until the ssl expires"""
-        expiry_time = self.ssl_property_to_py("expiry")
-        # expiry_time = datetime.now(timezone.utc)
-        # time.sleep(5)
-        time_now = datetime.now(timezone.utc)
-        remain = relativedelta.relativedelta(expiry_time, time_now)
-        if remain.years == 0:
-            rem_yr = None
-        else:
-            rem_yr = "%d year" % remain.years if (remain.years == 1) or (remain.years == -1) else "%d years" % remain.years  # if singular, use singular
-
-        rem_mth = "%d month" % remain.months if (remain.months == 1) or (remain.months == -1) else "%d months" % remain.months
-        rem_wks = "%d week" % remain.weeks if (remain.weeks == 1) or (remain.weeks == -1) else "%d weeks" % remain.weeks
-        seven = 7 if remain.days >= 0 else -7  # needs to be a minus to get correct modulus if number of days is a minus (i.e. certificate has expired)
-        rem_days = "%d day" % (remain.days % seven) if (remain.days % seven == 1) or (remain.days % seven == -1) else "%d days" % (remain.days % seven)  # modulus of dividing days by 7
-
-        if rem_yr:
-            countdown_string = "{0}, {1}, {2}, {3}".format(rem_yr, rem_mth, rem_wks, rem_days)  # only show years if years are relevant
-        else:
-            countdown_string = "{0}, {1}, {2}".format(rem_mth, rem_wks, rem_days)
-        return countdown_string
+        return countdown_from_timestamp(self.expiry_epoch)
 
     def get_organisation(self, org_type):
         """
@@ -181,7 +238,7 @@ class Certificate:
 
         returns organisation name for subject or issuer. if not found, returns common name. if still not found returns 'NA' as a string """
 
-        org_components = self.ssl_property_to_py("{0}".format(org_type))
+        org_components = self.ssl_property_to_py(org_type)
 
         for k, v in org_components:
             if k == "O":
@@ -194,79 +251,86 @@ class Certificate:
                 return "NA"  # implement url
 
 
-address = sys.argv[1]  # first parameter after script name
-options = sys.argv[2:]  # optional arguments passed into the script (all args after the address parameter)
-
-port = 443
-readable = False
-local = False
-expiry = True
-start = False
-issuer = False
-issuer_short = False
-number = False
-countdown = False
-countdown_short = False
-# verbose = False
-offset = None
-subject_name = False
-forgiving = False
-timeout = 5
-forgiving_error = False
-
-error_message = []  # list of strings ?
-
-
-# TODO cutdown single letter flags!
-
-opts, unknown = getopt.getopt(options, "p:ferlsitncuo:a", ["for", "port=", "expiry", "ts_to_readable", "local", "start", "issuer", "issuershort", "number", "countdown", "countdownshort", "offset=", "forgiving", "timeout=", "all"])  # looks for -p or --port in provided arguments
-
-for opt, arg in opts:
-    if opt == ("-p" or "--port"):
-        port = int(arg)  # set port from provided arguments
-    elif opt == ("-e" or "--expiry"):
-        expiry = True
-    elif opt == ("-r" or "--ts_to_readable"):
-        readable = True
-    elif opt == ("-l" or "--local"):
-        local = True
-    elif opt == ("-s" or "--start"):
-        start = True
-    elif opt == ("-i" or "--issuer"):
-        issuer = True
-    elif opt == ("-t" or "--issuershort"):
-        issuer_short = True
-    elif opt == ("-n" or "--number"):
-        number = True
-    elif opt == ("-c" or "--countdown"):
-        countdown = True
-    elif opt == ("-u" or "--countdownshort"):
-        countdown_short = True
-    elif opt == ("-o" or "--offset"):
-        offset = arg
-    elif opt == ("-f" or "--for"):
-        subject_name = True
-    elif opt == "--forgiving":
-        forgiving = True
-    elif opt == "--timeout":
-        timeout = int(arg)
-    elif opt == "-a" or opt == "--all":
-        local = True
-        expiry = True
-        start = True
-        issuer_short = True
-        number = True
-        countdown_short = True
-        subject_name = True
-        # forgiving = True
-
-if unknown:
-    error_01 = "Unknown arguments provided: {0}".format(unknown)
-    error_message.append(error_01)
-
-
-# if verbose:
-#     print("get certificate from {0}:{1}".format(address, port))
+def format_countdown(expiry_time):
+    """ return the time until the expiry datetime as a string of years, months, weeks and days """
+    time_now = datetime.now(timezone.utc)
+    return format_remaining(relativedelta.relativedelta(expiry_time, time_now))
+
+
+def format_remaining(remain):
+    """ return a relativedelta as a string of years, months, weeks and days """
+    if remain.years == 0:
+        rem_yr = None
+    else:
+        rem_yr = "%d year" % remain.years if (remain.years == 1) or (remain.years == -1) else "%d years" % remain.years  # if singular, use singular
+
+    rem_mth = "%d month" % remain.months if (remain.months == 1) or (remain.months == -1) else "%d months" % remain.months
+    rem_wks = "%d week" % remain.weeks if (remain.weeks == 1) or (remain.weeks == -1) else "%d weeks" % remain.weeks
+    seven = 7 if remain.days >= 0 else -7  # needs to be a minus to get correct modulus if number of days is a minus (i.e. certificate has expired)
+    rem_days = "%d day" % (remain.days % seven) if (remain.days % seven == 1) or (remain.days % seven == -1) else "%d days" % (remain.days % seven)  # modulus of dividing days by 7
+
+    if rem_yr:
+        countdown_string = "{0}, {1}, {2}, {3}".format(rem_yr, rem_mth, rem_wks, rem_days)  # only show years if years are relevant
+    else:
+        countdown_string = "{0}, {1}, {2}".format(rem_mth, rem_wks, rem_days)
+    return countdown_string
+
+
+@functools.lru_cache(maxsize=4096)
+def countdown_for_days(expiry_day, now_day):
+    """ the countdown string from now_day to expiry_day (whole days since 1 Jan 1970 utc). memoised - the sites of a run
+    share a small number of expiry days and every countdown worked out on a day has the same now_day """
+    epoch = date(1970, 1, 1)
+    return format_remaining(relativedelta.relativedelta(epoch + timedelta(days=expiry_day), epoch + timedelta(days=now_day)))
+
+
+def countdown_from_timestamp(expiry, time_now=None):
+    """ return the countdown string for an expiry timestamp (e.g. the "expiry" of a stored site object), counted in
+    whole days (utc) from time_now (a timestamp, now if not given) """
+    time_now = time_now if time_now else time.time()
+    return countdown_for_days(int(expiry // 86400), int(time_now // 86400))
+
+
+# site properties returned by the --all option (and by RunSSL for each site)
+ALL_FIELDS = ("name", "expiry", "start", "issuer", "number", "countdown")
+ALL_OPTIONS = {"local": True, "issuer_short": True}
+
+
+class ProbeResult:
+    """ stores the outcome of a single certificate probe. errors are collected in the order they occur """
+
+    def __init__(self, hostname, port):
+        self.hostname = hostname
+        self.port = port
+        self.certificate = None
+        self.errors = []
+        self.timings = {}  # seconds spent on each stage of the probe e.g. "resolve", "tls"
+        self.peer = {}  # the "address" and "family" (IPv4 or IPv6) that the connection was made to, and the seconds taken to "connect" and "handshake"
+        self.address_results = []  # one ProbeResult per address when every address of the host is probed
+        self.divergent = False  # the addresses of the host did not all serve the same certificate
+        self.unreachable = []  # addresses of the host that gave no certificate while another address served one
+        self.fingerprint = None  # sha-256 of the certificate's der bytes - identical for every host that serves the same certificate
+
+    def to_dict(self, fields=ALL_FIELDS):
+        """ return the result log for the requested fields - this is the site object used by the rest of the app """
+        result_log = {}
+
+        if self.certificate:
+            field_values = {
+                "name": self.certificate.subject_org,
+                "expiry": self.certificate.expiry,
+                "start": self.certificate.start,
+                "issuer": self.certificate.issuer,
+                "number": self.certificate.serial,
+                "countdown": self.certificate.countdown
+            }
+            for field in fields:
+                result_log[field] = field_values[field]
+
+        if self.errors:
+            result_log["error"] = ", ".join(reversed(self.errors))  # get a single string of errors, last error first
+
+        return result_log
 
 
 def clean_url(address):
@@ -281,126 +345,615 @@ def clean_url(address):
     return hostname
 
 
-hostname = clean_url(address)
+def get_context(sslv23=False):
+    """ returns the shared ssl context used for the handshake. the sslv23 context does not verify the certificate """
+    return registry.get_context(context_mode(sslv23))
+
+
+def context_mode(sslv23=False):
+    """ the ssl_contexts.registry mode for the handshake """
+    return "unverified" if sslv23 else "verify"
+
+
+HAPPY_EYEBALLS_DELAY = 0.25  # seconds before the next connection attempt is started (rfc 8305 connection attempt delay)
+ADDRESS_FAMILIES = {socket.AF_INET: "IPv4", socket.AF_INET6: "IPv6"}
+
+
+def interleave_addresses(addresses):
+    """ orders (family, address) tuples for happy eyeballs - alternating between address families, IPv6 first
+    (rfc 8305 section 4) """
+    by_family = {}
+    for family, address in addresses:
+        by_family.setdefault(family, []).append((family, address))
+    family_lists = sorted(by_family.values(), key=lambda family_list: family_list[0][0] != socket.AF_INET6)
+
+    ordered = []
+    for index in range(max(len(family_list) for family_list in family_lists)):
+        ordered.extend(family_list[index] for family_list in family_lists if index < len(family_list))
+    return ordered
+
+
+def first_address(addresses):
+    """ the (family, address) happy eyeballs tries first, as a list of one - or an empty list if there are no addresses.
+    this is the address a probe of the host is charged to by the per address limit (see probe_limits.DestinationLimits) """
+    return interleave_addresses(addresses)[:1] if addresses else []
+
+
+def record_peer(sock, peer, started=None):
+    """ stores the address and family of the connected socket in the peer dictionary (if one is provided). if the time
+    the connection was started is given, the seconds taken to connect are stored as "connect" """
+    if peer is not None:
+        peer["address"] = sock.getpeername()[0]
+        peer["family"] = ADDRESS_FAMILIES.get(sock.family, str(sock.family))
+        if started:
+            peer["connected_at"] = time.time()
+            peer["connect"] = peer["connected_at"] - started
+
 
+def record_handshake(peer):
+    """ stores the seconds taken by the tls handshake as "handshake", if the connect time was recorded """
+    if peer and "connected_at" in peer:
+        peer["handshake"] = time.time() - peer.pop("connected_at")
 
 
-def get_pem_cert(hostname, port, timeout, sslv23=False, error_count=0, forgive_flow=False):
-    global forgiving_error
+def happy_eyeballs_connect(hostname, port, timeout, addresses, delay=HAPPY_EYEBALLS_DELAY):
+    """ staggered parallel connection attempts across the addresses (rfc 8305). a new attempt starts every 'delay'
+    seconds, or straight away when an attempt fails, and each attempt has its own 'timeout' deadline.
+    returns the first socket to connect, all other attempts are closed """
+    pending = interleave_addresses(addresses)
+    if not pending:
+        raise OSError("no addresses found for {0}".format(hostname))
+
+    selector = selectors.DefaultSelector()
+    attempts = {}  # socket: deadline
+    next_start = time.time()
+    last_error = None
+    try:
+        while pending or attempts:
+            now = time.time()
+            if pending and now >= next_start:
+                family, address = pending.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                error_code = sock.connect_ex((address, port))
+                if error_code in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    attempts[sock] = now + timeout
+                    next_start = now + delay
+                else:
+                    sock.close()
+                    last_error = OSError(error_code, os.strerror(error_code))
+                continue
+
+            wake_times = list(attempts.values()) + ([next_start] if pending else [])
+            for key, _ in selector.select(max(0, min(wake_times) - now)):
+                sock = key.fileobj
+                selector.unregister(sock)
+                del attempts[sock]
+                error_code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error_code == 0:
+                    sock.settimeout(timeout)  # the handshake uses the socket in timeout mode, as create_connection does
+                    return sock
+                sock.close()
+                last_error = OSError(error_code, os.strerror(error_code))
+                next_start = time.time()  # an attempt failed - start the next one now
+
+            for sock, deadline in list(attempts.items()):
+                if deadline <= time.time():
+                    selector.unregister(sock)
+                    del attempts[sock]
+                    sock.close()
+                    last_error = socket.timeout("timed out")
+                    next_start = time.time()
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
+
+    raise last_error
+
+
+def create_connection(hostname, port, timeout, addresses=None, peer=None):
+    """ returns a socket connected to the host. addresses is a list of pre-resolved (family, address) tuples which are
+    tried with happy eyeballs, if it is None the hostname is resolved as part of the connection.
+    the address, family and connect time are stored in the peer dictionary if provided """
+    started = time.time()
+    if addresses is None:
+        sock = socket.create_connection((hostname, port), timeout=timeout)
+    else:
+        sock = happy_eyeballs_connect(hostname, port, timeout, addresses)
+    try:
+        record_peer(sock, peer, started)
+    except OSError:
+        pass  # the connection has already dropped - the handshake will report it
+    return sock
+
+
+def get_der_cert(hostname, port, timeout, error_message, sslv23=False, error_count=0, addresses=None, peer=None):
+    """ returns a tuple of the der certificate bytes (or None) and whether an ssl error was encountered on the way.
+    error strings are appended to the error_message list provided """
     error_count = error_count
     # print("attempt: " + str(error_count))
     if error_count < 2:
-        if sslv23:
-            context = ssl.SSLContext(
-                ssl.PROTOCOL_SSLv23)  # SSLv23 deprecated in Python 3.6 but works see above. UPDATE: use this version to return expired SSLs
-        else:
-            context = ssl.create_default_context()  # Python Mac OS issue. Install Certificates.command from Applications/Python 3.6 folder or use SSLv23. https://stackoverflow.com/questions/41691327/ssl-sslerror-ssl-certificate-verify-failed-certificate-verify-failed-ssl-c
+        context = get_context(sslv23)
         try:
-            with socket.create_connection((hostname, port), timeout=timeout) as sock:  # create a socket (port and url)
+            with create_connection(hostname, port, timeout, addresses, peer) as sock:  # create a socket (port and url)
                 with context.wrap_socket(sock, server_hostname=hostname) as ssock:  # add a context to the socket (handshake information)
-                    pem_cert = ssl.DER_cert_to_PEM_cert(ssock.getpeercert(True))  # use the socket to get the peer certificate
-            return pem_cert
+                    der_cert = ssock.getpeercert(True)  # use the socket to get the peer certificate
+                    record_handshake(peer)
+            return der_cert, False
         except socket.timeout:
             error_04 = "*Timed out during original certificate retrieval*"
             error_message.append(error_04)
-            return None
+            return None, False
         except ssl.CertificateError as cert_err:
             error_count += 1
             error_12 = "SSL Certificate error: {0} ".format(cert_err)
             error_message.append(error_12)
-            pem_cert = get_pem_cert(hostname, port, timeout, sslv23=True, error_count=error_count)
-            if forgive_flow:
-                forgiving_error = True
-            return pem_cert
+            der_cert, _ = get_der_cert(hostname, port, timeout, error_message, sslv23=True, error_count=error_count,
+                                       addresses=addresses, peer=peer)
+            return der_cert, True
         except ssl.SSLError as ssl_err:
             error_count += 1
             # error_13 = "Warning: SSL error: {0} ".format(ssl_err)
             # error_message.append(error_13)
-            pem_cert = get_pem_cert(hostname, port, timeout, sslv23=True, error_count=error_count)
-            if forgive_flow:
-                forgiving_error = True
-            return pem_cert
+            der_cert, _ = get_der_cert(hostname, port, timeout, error_message, sslv23=True, error_count=error_count,
+                                       addresses=addresses, peer=peer)
+            return der_cert, True
         except:
             # raise
             error_05 = "* Unable to connect to {0}. *".format(hostname)
             error_message.append(error_05)
-            return None
+            return None, False
     else:
         # error_14 = "* Too many errors encountered - stopped. *".format(hostname)
         # error_message.append(error_14)
-        return None
+        return None, False
 
 
-f = open("timeout.txt", "a")
-f.write("time out is {0}. forgiveness is {1} \n".format(timeout, forgiving))
+def match_dns_name(pattern, hostname):
+    """ matches a certificate dns name against the hostname. a wildcard may only be the whole left-most label """
+    pattern_labels = pattern.lower().rstrip(".").split(".")
+    host_labels = hostname.lower().rstrip(".").split(".")
+    if len(pattern_labels) != len(host_labels):
+        return False
+    if pattern_labels[0] == "*":
+        return len(pattern_labels) > 2 and pattern_labels[1:] == host_labels[1:]
+    return pattern_labels == host_labels
 
-f.close()
 
-pem_cert = get_pem_cert(hostname, port, timeout)
+def match_hostname(x509_cert, hostname):
+    """ returns True if the certificate is valid for the hostname. uses the subject alternative names, or the common
+    name if the certificate has no dns names """
+    crypto_cert = x509_cert.to_cryptography()
+    try:
+        alt_names = crypto_cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        dns_names = alt_names.get_values_for_type(x509.DNSName)
+        ip_addresses = alt_names.get_values_for_type(x509.IPAddress)
+    except x509.ExtensionNotFound:
+        dns_names = []
+        ip_addresses = []
 
-if not pem_cert and forgiving:
     try:
-        urllib_response = urlopen("http://" + hostname, timeout=timeout)
-        final_url = urllib_response.url
-        parsed_url = urlparse(final_url)
-        if not clean_url(parsed_url.hostname) == hostname:  # if the final url is different to the original, there must be a redirect
-            redirect_hostname = urlparse(final_url).hostname
-            pem_cert = get_pem_cert(redirect_hostname, port, timeout=timeout, forgive_flow=True)
-            if pem_cert and not forgiving_error:
-                error_06 = "SOFT PASS: Domain has no valid SSL but a valid SSL was found on the redirected domain: {0}".format(redirect_hostname)
-                error_message.append(error_06)
-            elif pem_cert and forgiving_error:
-                error_16 = "SSL error on redirected domain: {0}".format(redirect_hostname)
-                error_message.append(error_16)
-            else:
-                error_07 = "Redirect: No ssl found on redirected domain {0}"
-                error_message.append(error_07)
+        return ipaddress.ip_address(hostname) in ip_addresses
+    except ValueError:
+        pass  # not an ip address
+
+    if not dns_names:
+        dns_names = [value.decode("utf-8") for key, value in x509_cert.get_subject().get_components() if key == b"CN"]
+
+    return any(match_dns_name(name, hostname) for name in dns_names)
 
+
+def verify_chain(hostname, chain):
+    """ verifies a peer certificate chain (leaf first) against the trust store and the hostname.
+    returns None if the certificate is valid, else the reason it is not """
+    try:
+        crypto.X509StoreContext(registry.get_trust_store(), chain[0], chain[1:]).verify_certificate()
+    except crypto.X509StoreContextError as err:
+        reason = err.args[0]
+        if isinstance(reason, list):
+            reason = reason[2]  # older pyOpenSSL versions give [error code, depth, reason]
+        return "certificate verify failed: {0}".format(reason)
+
+    if not match_hostname(chain[0], hostname):
+        return "certificate verify failed: Hostname mismatch, certificate is not valid for '{0}'.".format(hostname)
+
+    return None
+
+
+def create_capture_connection(hostname, port):
+    """ returns an unverified pyOpenSSL client connection using memory buffers, so the handshake can be driven by
+    either a blocking socket or an asyncio stream """
+    connection = SSL.Connection(registry.get_context("capture"), None)
+    try:
+        ipaddress.ip_address(hostname)  # SNI is not sent for ip addresses
+    except ValueError:
+        connection.set_tlsext_host_name(hostname.encode("idna"))
+    connection.set_connect_state()
+    return connection
+
+
+def read_outgoing(connection):
+    """ returns the handshake bytes waiting to be sent to the server """
+    chunks = []
+    while True:
+        try:
+            chunks.append(connection.bio_read(16384))
+        except SSL.WantReadError:
+            return b"".join(chunks)
+
+
+def get_captured_chain(connection):
+    """ returns the peer chain once the capture handshake is complete """
+    return connection.get_peer_cert_chain()
+
+
+def check_captured_chain(hostname, chain, error_message):
+    """ verifies the captured chain offline. returns the same (der_cert, ssl_error) tuple as get_der_cert """
+    der_cert = crypto.dump_certificate(crypto.FILETYPE_ASN1, chain[0])
+    reason = verify_chain(hostname, chain)
+    if reason:
+        error_12 = "SSL Certificate error: {0} ".format(reason)
+        error_message.append(error_12)
+        return der_cert, True
+    return der_cert, False
+
+
+def handshake_error(ssl_err):
+    """ the error message for a capture handshake that failed, with the reasons openssl gave (e.g. 'sslv3 alert
+    handshake failure') """
+    reasons = ssl_err.args[0] if ssl_err.args else None
+    if isinstance(reasons, list):
+        reasons = "; ".join(str(reason[-1]) if isinstance(reason, tuple) else str(reason) for reason in reasons)
+    error_18 = "*SSL handshake error: {0}*".format(reasons or "no reason given")
+    return error_18
+
+
+def capture_der_cert(hostname, port, timeout, error_message, addresses=None, peer=None):
+    """ single handshake alternative to get_der_cert. the certificate chain is captured from one unverified handshake
+    and then verified offline, rather than handshaking a second time after a verification error.
+    returns the same (der_cert, ssl_error) tuple as get_der_cert """
+    try:
+        with create_connection(hostname, port, timeout, addresses, peer) as sock:
+            connection = create_capture_connection(hostname, port)
+            while True:
+                try:
+                    connection.do_handshake()
+                    break
+                except SSL.WantReadError:
+                    sock.sendall(read_outgoing(connection))
+                    data = sock.recv(16384)
+                    if not data:
+                        raise SSL.Error("connection closed during handshake")
+                    connection.bio_write(data)
+            sock.sendall(read_outgoing(connection))  # complete the handshake from our side
+            record_handshake(peer)
+            chain = get_captured_chain(connection)
+    except socket.timeout:
+        error_04 = "*Timed out during original certificate retrieval*"
+        error_message.append(error_04)
+        return None, False
+    except SSL.Error as ssl_err:
+        error_message.append(handshake_error(ssl_err))  # the handshake failed - no certificate to verify
+        return None, True
+    except:
+        error_05 = "* Unable to connect to {0}. *".format(hostname)
+        error_message.append(error_05)
+        return None, False
+
+    if not chain:
+        return None, False
+    return check_captured_chain(hostname, chain, error_message)
+
+
+def fetch_der_cert(hostname, port, timeout, error_message, capture=False, addresses=None, peer=None):
+    """ returns the (der_cert, ssl_error) tuple using a single handshake if capture is set, else the verify and retry
+    handshakes of get_der_cert """
+    if capture:
+        return capture_der_cert(hostname, port, timeout, error_message, addresses, peer)
+    return get_der_cert(hostname, port, timeout, error_message, addresses=addresses, peer=peer)
+
+
+def find_redirect(hostname, timeout, error_message):
+    """ forgiving mode: returns the domain that http://hostname redirects to, or None if there is no redirect (or it
+    could not be followed). redirects are looked up with headers only and cached (see redirects.resolve_redirect) """
+    try:
+        redirect_hostname = redirects.resolve_redirect(hostname, timeout)
+        if not clean_url(redirect_hostname) == hostname:  # if the final host is different to the original, there must be a redirect
+            return redirect_hostname
         else:
             "Redirect: No redirect to check"
     except socket.timeout:
         error_03 = "*Redirect: Timed out during redirect*"
         error_message.append(error_03)
-    except urllib.error.URLError:
-        pass
     except ssl.CertificateError as err:
         error_10 = "*Redirect: SSL Certificate error: {0}*".format(err)
         error_message.append(error_10)
+    except (OSError, http.client.HTTPException):
+        pass
     except:
         pass
+    return None
+
+
+def redirect_message(redirect_hostname, der_cert, forgiving_error):
+    """ describes the certificate found on the redirected domain """
+    if der_cert and not forgiving_error:
+        error_06 = "SOFT PASS: Domain has no valid SSL but a valid SSL was found on the redirected domain: {0}".format(redirect_hostname)
+        return error_06
+    elif der_cert and forgiving_error:
+        error_16 = "SSL error on redirected domain: {0}".format(redirect_hostname)
+        return error_16
+    else:
+        error_07 = "Redirect: No ssl found on redirected domain {0}".format(redirect_hostname)
+        return error_07
+
+
+def get_redirect_der_cert(hostname, port, timeout, error_message, capture=False, probe_cache=None):
+    """ forgiving mode: if the domain redirects to another domain, return the certificate from the redirected domain.
+    the certificate is taken from the probe cache (see probe_cache.ProbeCache.get_certificate) if the redirected domain
+    has been probed recently """
+    der_cert = None
+    redirect_hostname = find_redirect(hostname, timeout, error_message)
+    if redirect_hostname:
+        cached = probe_cache.get_certificate(redirect_hostname, port) if probe_cache else None
+        if cached:
+            der_cert, forgiving_error = cached
+        else:
+            der_cert, forgiving_error = fetch_der_cert(redirect_hostname, port, timeout, error_message, capture,
+                                                       resolver.cache.get(redirect_hostname))
+        error_message.append(redirect_message(redirect_hostname, der_cert, forgiving_error))
+    return der_cert
+
+
+class CertificateCache:
+    """ lru cache of parsed Certificate objects keyed by the certificate's fingerprint and the Certificate options, so
+    a san or wildcard certificate served by many hosts is only parsed and formatted once. entries are dropped after
+    'ttl' seconds so the countdown of a cached certificate stays current """
+
+    def __init__(self, max_entries=1024, ttl=10 * 60):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (fingerprint, options): (expires_at, Certificate)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def fingerprint(der_cert):
+        """ hex sha-256 of the certificate's der bytes """
+        return hashlib.sha256(der_cert).hexdigest()
+
+    def get(self, fingerprint, der_cert, **cert_options):
+        """ returns the Certificate for the der certificate, parsing it only if it is not cached """
+        key = (fingerprint, tuple(sorted(cert_options.items())))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
 
-if not pem_cert:
-    error_02 = "Could not connect to host: {0} on port: {1}.".format(hostname, port)
-    error_message.append(error_02)
+        certificate = Certificate(der_cert, **cert_options)
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, certificate)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)  # least recently used
+        return certificate
 
 
-# create result log
-result_log = {}
+certificates = CertificateCache()
 
-if pem_cert and ("BEGIN CERTIFICATE" in pem_cert):
-    certificate = Certificate(pem_cert)
 
-    organisation = certificate.get_organisation("subject")
+def load_certificate(result, der_cert, **cert_options):
+    """ record the outcome of a certificate retrieval on the probe result. certificates are parsed through the
+    certificate cache and the result is given the certificate's fingerprint """
+    if not der_cert:
+        error_02 = "Could not connect to host: {0} on port: {1}.".format(result.hostname, result.port)
+        result.errors.append(error_02)
 
-    if subject_name:
-        result_log["name"] = certificate.subject_org
-    if expiry:
-        result_log["expiry"] = certificate.expiry
-    if start:
-        result_log["start"] = certificate.start
-    if issuer or issuer_short:
-        result_log["issuer"] = certificate.issuer
-    if number:
-        result_log["number"] = certificate.serial
-    if countdown or countdown_short:
-        result_log["countdown"] = certificate.countdown
+    if der_cert:
+        result.fingerprint = certificates.fingerprint(der_cert)
+        result.certificate = certificates.get(result.fingerprint, der_cert, **cert_options)
 
-if error_message:
-    error_message.reverse()  # print the last error first
-    result_log["error"] = ", ".join(error_message)  # get a single string of errors
+    return result
+
+
+def probe(host, port=443, timeout=5, forgiving=False, capture=False, addresses=None, probe_cache=None, **cert_options):
+    """ retrieve and parse the certificate for a single host. returns a ProbeResult.
+    capture uses a single handshake with offline verification (see capture_der_cert).
+    addresses is an optional list of pre-resolved (family, address) tuples for the host (see resolver.Resolver).
+    probe_cache is an optional probe_cache.ProbeCache that keeps the certificate and answers redirect re-probes.
+    cert_options are passed through to Certificate (readable, local, offset, issuer_short) """
+    hostname = clean_url(host)
+    result = ProbeResult(hostname, port)
+    started = time.time()
+
+    der_cert, ssl_error = fetch_der_cert(hostname, port, timeout, result.errors, capture, addresses, result.peer)
+    if der_cert and probe_cache:
+        probe_cache.keep_certificate(hostname, port, der_cert, ssl_error)
+
+    if not der_cert and forgiving:
+        der_cert = get_redirect_der_cert(hostname, port, timeout, result.errors, capture, probe_cache)
+
+    result.timings["tls"] = time.time() - started
+
+    return load_certificate(result, der_cert, **cert_options)
+
+
+ADDRESS_FANOUT = 8  # max concurrent handshakes per host when every address is probed
+
+
+def certificate_key(result):
+    """ identifies the certificate served in a probe result (its fingerprint). None if no certificate was returned """
+    if not result.certificate:
+        return None
+    return result.fingerprint
+
+
+def merge_address_results(hostname, port, results):
+    """ collapses the results from each address of a host into a single result. if every address that served a
+    certificate served the same one the result matches a normal probe, otherwise it is flagged as divergent with an
+    error listing the certificate seen at each address. addresses that gave no certificate (e.g. an ipv6 address that
+    cannot be reached from the worker) are not compared - they are listed in unreachable, which is not an error. the
+    per address results are kept in address_results """
+    chosen = next((result for result in results if result.certificate), results[0])
+
+    merged = ProbeResult(hostname, port)
+    merged.certificate = chosen.certificate
+    merged.fingerprint = chosen.fingerprint
+    merged.errors = list(chosen.errors)
+    merged.peer = dict(chosen.peer)
+    merged.timings = dict(chosen.timings)
+    merged.timings["tls"] = max(result.timings.get("tls", 0.0) for result in results)  # the addresses are probed concurrently
+    merged.address_results = results
+
+    served = [result for result in results if result.certificate]
+    if served:
+        merged.unreachable = [result.peer.get("address") for result in results if not result.certificate]
+
+    if len(set(certificate_key(result) for result in served)) > 1:
+        merged.divergent = True
+        served = ["{0} (serial {1})".format(result.peer.get("address"), result.certificate.serial)
+                  for result in served]
+        error_17 = "*Certificates differ between addresses: {0}*".format(", ".join(served))
+        merged.errors.append(error_17)
+
+    return merged
+
+
+def probe_each_address(host, port=443, timeout=5, forgiving=False, capture=False, addresses=None,
+                       fanout=ADDRESS_FANOUT, probe_cache=None, **cert_options):
+    """ probe every pre-resolved (family, address) of the host concurrently, no more than 'fanout' at a time.
+    returns a single ProbeResult (see merge_address_results). if no address served a certificate and forgiving is set,
+    the host is probed normally so that a redirect can be followed """
+    hostname = clean_url(host)
+    if not addresses or len(addresses) < 2:
+        return probe(host, port, timeout, forgiving, capture, addresses, probe_cache, **cert_options)
+
+    def probe_address(family, address):
+        result = probe(hostname, port, timeout, False, capture, [(family, address)], probe_cache, **cert_options)
+        result.peer.setdefault("address", address)
+        result.peer.setdefault("family", ADDRESS_FAMILIES.get(family, str(family)))
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(fanout, len(addresses))) as executor:
+        results = list(executor.map(lambda address: probe_address(*address), addresses))
+
+    merged = merge_address_results(hostname, port, results)
+    if not merged.certificate and forgiving:
+        return probe(host, port, timeout, forgiving, capture, addresses, probe_cache, **cert_options)
+    return merged
+
+
+def main(argv):
+    """ command line wrapper. prints the result log for a single address as json """
+    address = argv[0]  # first parameter after script name
+    options = argv[1:]  # optional arguments passed into the script (all args after the address parameter)
+
+    port = 443
+    readable = False
+    local = False
+    expiry = True
+    start = False
+    issuer = False
+    issuer_short = False
+    number = False
+    countdown = False
+    countdown_short = False
+    # verbose = False
+    offset = None
+    subject_name = False
+    forgiving = False
+    timeout = 5
+    use_async = False
+    capture = False
+    all_addresses = False
+
+    # TODO cutdown single letter flags!
+
+    opts, unknown = getopt.getopt(options, "p:ferlsitncuo:a", ["for", "port=", "expiry", "ts_to_readable", "local", "start", "issuer", "issuershort", "number", "countdown", "countdownshort", "offset=", "forgiving", "timeout=", "all", "async", "capture", "alladdresses"])  # looks for -p or --port in provided arguments
+
+    for opt, arg in opts:
+        if opt == ("-p" or "--port"):
+            port = int(arg)  # set port from provided arguments
+        elif opt == ("-e" or "--expiry"):
+            expiry = True
+        elif opt == ("-r" or "--ts_to_readable"):
+            readable = True
+        elif opt == ("-l" or "--local"):
+            local = True
+        elif opt == ("-s" or "--start"):
+            start = True
+        elif opt == ("-i" or "--issuer"):
+            issuer = True
+        elif opt == ("-t" or "--issuershort"):
+            issuer_short = True
+        elif opt == ("-n" or "--number"):
+            number = True
+        elif opt == ("-c" or "--countdown"):
+            countdown = True
+        elif opt == ("-u" or "--countdownshort"):
+            countdown_short = True
+        elif opt == ("-o" or "--offset"):
+            offset = arg
+        elif opt == ("-f" or "--for"):
+            subject_name = True
+        elif opt == "--forgiving":
+            forgiving = True
+        elif opt == "--timeout":
+            timeout = int(arg)
+        elif opt == "--async":
+            use_async = True
+        elif opt == "--capture":
+            capture = True
+        elif opt == "--alladdresses":
+            all_addresses = True
+        elif opt == "-a" or opt == "--all":
+            local = True
+            expiry = True
+            start = True
+            issuer_short = True
+            number = True
+            countdown_short = True
+            subject_name = True
+            # forgiving = True
+
+    # if verbose:
+    #     print("get certificate from {0}:{1}".format(address, port))
+
+    f = open("timeout.txt", "a")
+    f.write("time out is {0}. forgiveness is {1} \n".format(timeout, forgiving))
+
+    f.close()
+
+    cert_options = {"readable": readable, "local": local, "offset": offset, "issuer_short": issuer_short}
+    if use_async:
+        from probe_engine import ProbeEngine  # imported here - probe_engine imports this module
+        from resolver import Resolver
+        engine = ProbeEngine(timeout=timeout, forgiving=forgiving, capture=capture, resolver=Resolver(timeout),
+                             all_addresses=all_addresses, cert_options=cert_options)
+        result = engine.run([(address, port)])[0]
+    elif all_addresses:
+        from resolver import Resolver
+        hostname = clean_url(address)
+        addresses = Resolver(timeout).run([hostname])[hostname]
+        result = probe_each_address(address, port, timeout, forgiving, capture, addresses, **cert_options)
+    else:
+        result = probe(address, port, timeout, forgiving, capture, **cert_options)
 
+    if unknown:
+        error_01 = "Unknown arguments provided: {0}".format(unknown)
+        result.errors.insert(0, error_01)
 
-print(json.dumps(result_log))
+    fields = [field for field, wanted in (("name", subject_name), ("expiry", expiry), ("start", start),
+                                          ("issuer", issuer or issuer_short), ("number", number),
+                                          ("countdown", countdown or countdown_short)) if wanted]
 
+    print(json.dumps(result.to_dict(fields)))
 
 
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -79,6 +79,7 @@ def form_ssl_checker():
         form_timeout = 2 if not frequest.form.get("timeout") else frequest.form.get("timeout")
 
         management_sheet_id = None if not frequest.form.get("management_sheet_id") else frequest.form.get("management_sheet_id")
+        form_scheduled = frequest.form.get("scheduled") == "true"  # set by the refresh link (sheet-update) form
 
         def get_sheet_id(sheet_url):
             id_match = re.search(r"(?<=spreadsheets/d/).*?($|(?=[$\?#=/]))", sheet_url)  # all characters between d/ and end of string OR tp the first / or other break
@@ -127,7 +128,8 @@ def form_ssl_checker():
 
         result_html = ssl_checker(sheet_id, dashboard_tab=dashboard_tab, email_tab=email_tab, domains_tab=domains_tab,
                                   web=True, form_sites=form_site_list, form_email_list=email_list,
-                                  forgiving=form_forgive, timeout=form_timeout, mgmt_sheet_id=management_sheet_id)
+                                  forgiving=form_forgive, timeout=form_timeout, mgmt_sheet_id=management_sheet_id,
+                                  scheduled=form_scheduled)
 
         dt_now = conversions.insert_date_now()
         date_stamp = "<br><p>Time Now: {0}</p>".format(dt_now)
@@ -137,7 +139,8 @@ def form_ssl_checker():
 
 
 def ssl_checker(sheet_id, dashboard_tab=None, email_tab=None, domains_tab=None, web=True, form_sites=None,
-                 mgmt_sheet_id=None, mgmt_tab_name=None, form_email_list=None, forgiving=False, timeout=5,update_tab=None):
+                 mgmt_sheet_id=None, mgmt_tab_name=None, form_email_list=None, forgiving=False, timeout=5,update_tab=None,
+                 scheduled=False, interactive=True):
 
     st = time.time()
     print('start time: ', st)
@@ -201,7 +204,8 @@ def ssl_checker(sheet_id, dashboard_tab=None, email_tab=None, domains_tab=None,
     recipients = mySheet.get_email_contacts()
 
     # create run object
-    run = RunSSL(domain_list, forgiving, timeout, mySheet, mgmtSheetObj, recipients, st)
+    run = RunSSL(domain_list, forgiving, timeout, mySheet, mgmtSheetObj, recipients, st, scheduled=scheduled,
+                 interactive=interactive)
 
     # DECISION #1 - ASSESS QUEUE LENGTH
     # Switch to background task if queue could take longer than Heroku timeout
@@ -209,15 +213,16 @@ def ssl_checker(sheet_id, dashboard_tab=None, email_tab=None, domains_tab=None,
     print("sites decision time: ", elapsed_time)
 
     print("http timeout is: {}".format(timeout))
-    max_queue_time = int(timeout)  # used to calculate queue time. initial value is timeout.
+    max_queue_time = run.longest_timeout(timeout)  # used to calculate queue time. initial value is the longest timeout a host can be given.
 
     threshold = 23 if not os.getenv("LOCALENV") else 255   # number of elapsed seconds before pushing to redis
     print("threshold is: ", threshold)
 
     if forgiving:
         max_queue_time = max_queue_time * 2  # double estimate if a redirect could be followed
-    if len(domain_list) > run.thread_max:  # if we cannot start all threads at the same time
-        max_queue_time = max_queue_time * math.ceil(len(domain_list) / run.thread_max)  # divide site qty by max threads and round up to next integer, then multiply by queue estimate
+    probe_workers = run.probe_workers()
+    if len(domain_list) > probe_workers:  # if we cannot start all probes at the same time
+        max_queue_time = max_queue_time * math.ceil(len(domain_list) / probe_workers)  # divide site qty by max probes and round up to next integer, then multiply by queue estimate
     max_queue_time = max_queue_time + elapsed_time
     print("max queue estimate is: ", max_queue_time)
     minutes_required = math.ceil(max_queue_time / 60)
@@ -241,6 +246,7 @@ def ssl_checker(sheet_id, dashboard_tab=None, email_tab=None, domains_tab=None,
             return web_msg.msg_with_error(result[1], result[2])
     else:
         # site_list = run.run_site_results()
+        run.request_budget = threshold  # waiting on domains that other runs are probing must not outlast the request
         site_list_result = run.run_site_results()
         if site_list_result[0] == 1:
             return web_msg.general_err_msg(site_list_result[1])
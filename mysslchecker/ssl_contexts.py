@@ -0,0 +1,67 @@
+import ssl
+import threading
+from OpenSSL import crypto, SSL
+
+
+class ContextRegistry:
+    """ process-wide store of the ssl contexts used by the probes, keyed by verification mode:
+    - verify (string) - ssl.create_default_context(), verifies the certificate during the handshake
+    - unverified (string) - PROTOCOL_SSLv23 context, used to return expired and invalid certificates
+    - capture (string) - unverified pyOpenSSL context used by the single handshake capture mode
+
+    each context (and the CA bundle it loads) is only built once. tls sessions are not resumed - a resumed session
+    returns the certificate from the original handshake, so a certificate renewed since then would not be seen """
+
+    modes = ("verify", "unverified", "capture")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contexts = {}
+        self._trust_store = None
+        self.stats = {
+            "context_hits": 0,
+            "context_misses": 0
+        }
+
+    @staticmethod
+    def create_context(mode):
+        """ build a new context for the verification mode """
+        if mode == "verify":
+            return ssl.create_default_context()  # Python Mac OS issue. Install Certificates.command from Applications/Python 3.6 folder or use SSLv23. https://stackoverflow.com/questions/41691327/ssl-sslerror-ssl-certificate-verify-failed-certificate-verify-failed-ssl-c
+        elif mode == "unverified":
+            return ssl.SSLContext(ssl.PROTOCOL_SSLv23)  # SSLv23 deprecated in Python 3.6 but works see above. UPDATE: use this version to return expired SSLs
+        elif mode == "capture":
+            return SSL.Context(SSL.SSLv23_METHOD)  # no verification - the chain is verified offline once captured
+        else:
+            raise Exception("ssl context mode not recognised: {0}".format(mode))
+
+    def get_context(self, mode):
+        """ returns the shared context for the verification mode, building it on first use """
+        with self._lock:
+            context = self._contexts.get(mode)
+            if context:
+                self.stats["context_hits"] += 1
+                return context
+            self.stats["context_misses"] += 1
+            context = self.create_context(mode)
+            self._contexts[mode] = context
+            return context
+
+    def get_trust_store(self):
+        """ returns the X509Store of trusted CA certificates used for offline verification. the system CA bundle is
+        only parsed on first use """
+        with self._lock:
+            if self._trust_store is None:
+                verify_paths = ssl.get_default_verify_paths()  # the same CA locations used by ssl.create_default_context()
+                store = crypto.X509Store()
+                store.load_locations(verify_paths.cafile, verify_paths.capath)
+                self._trust_store = store
+            return self._trust_store
+
+    def get_stats(self):
+        """ returns a copy of the hit and miss counters """
+        with self._lock:
+            return dict(self.stats)
+
+
+registry = ContextRegistry()
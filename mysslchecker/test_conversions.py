@@ -0,0 +1,14 @@
+import numpy as np
+import conversions
+
+
+def test_london_offsets_without_the_transition_table(monkeypatch):
+    timestamps = np.concatenate([np.floor(np.random.RandomState(1).uniform(0, 2.2e9, 1000)), [np.nan, np.inf]])
+    table_offsets = conversions.london_offsets(timestamps)
+
+    monkeypatch.setattr(conversions, "transition_table", lambda zone: None)  # as if pytz dropped its private table
+    offsets = conversions.london_offsets(timestamps)
+
+    assert (offsets == table_offsets).all()
+    assert set(offsets[:-2]) == {0.0, 3600.0}
+    assert offsets[-2] == offsets[-1] == 0.0  # missing dates are left to the caller
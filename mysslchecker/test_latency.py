@@ -0,0 +1,124 @@
+from types import SimpleNamespace
+from latency import LatencyHistory
+
+
+class FakeRedis:
+    """ the redis commands LatencyHistory uses, in memory. ttls are kept but never expire """
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def ttl(self, key):
+        return self.ttls.get(key) if key in self.values else -2
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.ttls[key] = ex
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.connection, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+def probe(connect=None, handshake=None):
+    """ a ProbeResult like object - a probe that timed out has no timings and no certificate """
+    peer = {"connect": connect, "handshake": handshake} if connect is not None else {}
+    return SimpleNamespace(hostname="slow.example.com", port=443, peer=peer, certificate=peer or None)
+
+
+def test_slowed_down_host_recovers():
+    latency = LatencyHistory(FakeRedis())
+    target = ("slow.example.com", 443)
+    for sample in range(10):
+        latency.record([probe(0.04, 0.04)])
+    assert latency.get_timeouts([target], 5)[target] == latency.floor
+
+    # the host now takes 3 seconds, so it fails at the learned timeout
+    latency.record([probe()])
+    timeout = latency.get_timeouts([target], 5)[target]
+    assert timeout >= 5  # no less than the run timeout once the host has failed
+
+    latency.record([probe(1.5, 1.5)])
+    assert latency.get_timeouts([target], 5)[target] > 3
+
+
+def test_timeout_doubles_for_each_failure():
+    latency = LatencyHistory(FakeRedis())
+    target = ("slow.example.com", 443)
+    for sample in range(10):
+        latency.record([probe(1, 1)])
+    learned = latency.get_timeouts([target])[target]
+
+    latency.record([probe()])
+    assert latency.get_timeouts([target])[target] == min(latency.ceiling, learned * 2)
+    latency.record([probe()])
+    assert latency.get_timeouts([target])[target] == min(latency.ceiling, learned * 4)
+    for run in range(5):
+        latency.record([probe()])
+    assert latency.get_timeouts([target])[target] == latency.ceiling
+
+    latency.record([probe(1, 1)])
+    assert latency.get_timeouts([target])[target] < learned * 2  # a success clears the failures
+
+
+def test_failures_do_not_extend_the_history():
+    connection = FakeRedis()
+    latency = LatencyHistory(connection)
+    latency.record([probe(0.08, 0.08)])
+    key = latency.key("slow.example.com", 443)
+    connection.ttls[key] = 1000  # part way through its 30 days
+
+    for run in range(5):
+        latency.record([probe()])
+    assert connection.ttls[key] == 1000
+
+    latency.record([probe(0.08, 0.08)])
+    assert connection.ttls[key] == 30 * 24 * 60 * 60
+
+
+def test_interactive_runs_cap_timeouts_at_the_run_timeout():
+    latency = LatencyHistory(FakeRedis())
+    target = ("slow.example.com", 443)
+    for sample in range(10):
+        latency.record([probe(4, 4)])
+    assert latency.get_timeouts([target], 2)[target] > 8  # a background run gives the host its learned timeout
+    assert latency.get_timeouts([target], 2, cap=2)[target] == 2
+
+    latency.record([probe()])
+    assert latency.get_timeouts([target], 2, cap=2)[target] == 2  # backed off, but still within the cap
+
+
+def test_history_is_read_once_per_run():
+    connection = FakeRedis()
+    LatencyHistory(connection).record([probe(0.5, 0.5)])
+    reads = []
+    mget = connection.mget
+    connection.mget = lambda keys: reads.append(keys) or mget(keys)
+
+    latency = LatencyHistory(connection)
+    targets = [("slow.example.com", 443), ("new.example.com", 443)]
+    timeouts = latency.get_timeouts(targets, 5)
+    durations = latency.expected_durations(targets, timeouts, 5)
+    baselines = latency.baselines(targets)
+    assert len(reads) == 1
+    assert set(timeouts) == set(baselines) == {("slow.example.com", 443)}
+    assert durations[("new.example.com", 443)] == 5
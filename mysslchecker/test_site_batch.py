@@ -0,0 +1,106 @@
+import copy
+import math
+import random
+from datetime import datetime
+from dateutil import relativedelta
+import pytest
+import conversions
+from site_batch import SiteBatch
+
+NOW = datetime(2026, 3, 29, 0, 30, 15)  # the night the clocks go forward in london
+SITE_KEYS = ["url", "expiry", "countdown", "start", "name", "issuer", "number", "error", "checked"]
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+
+def old_sorted_categories(site_list):
+    """ the dictionary implementation of conversions.get_sorted_categories that SiteBatch replaced """
+    valid_sites, invalid_sites, no_ssl_sites = [], [], []
+    for site in site_list:
+        if "expiry" not in site:
+            site["ssl_status"] = "missing"
+            no_ssl_sites.append(site)
+        elif "error" in site and "PASS" not in site["error"]:
+            site["ssl_status"] = "fail"
+            invalid_sites.append(site)
+        else:
+            site["ssl_status"] = "pass"
+            valid_sites.append(site)
+    return conversions.categorise_sites(conversions.sort_sites(no_ssl_sites, "url")
+                                        + conversions.sort_sites(invalid_sites, "url")
+                                        + conversions.sort_sites(valid_sites, "expiry"))
+
+
+def old_rows(categorised, site_keys):
+    """ the dashboard rows as RunSSL.run_dashboard_update wrote them from the category dictionary """
+    rows = []
+    for category in categorised:
+        for site in categorised[category]:
+            if site["ssl_status"] == "pass":
+                rows.append(["None" if key not in site else site[key] for key in site_keys])
+            else:
+                message = "** SSL certificate not found **" if site["ssl_status"] == "missing" else "** Invalid SSL **"
+                rows.append([message if key == "countdown" else site[key] if key in site else "" for key in site_keys])
+    return rows
+
+
+def without_nan_dates(site):
+    """ a nan date is a missing one in a SiteBatch. the old code raised for a nan expiry and wrote nan to the sheet for
+    the other dates, so it is given the site without them """
+    return {key: value for key, value in site.items()
+            if key not in ("expiry", "start", "checked") or not math.isnan(value)}
+
+
+def random_sites(seed, count):
+    rng = random.Random(seed)
+    now = NOW.timestamp()
+    edges = [(NOW + relativedelta.relativedelta(**delta)).timestamp() for delta in (
+        {}, {"days": +1}, {"days": +2}, {"weeks": +1}, {"weeks": +2}, {"months": +1}, {"months": +2}, {"months": +3},
+        {"months": +6})]
+    sites = []
+    for index in range(count):
+        site = {"url": "http://site{0}.example.com".format(rng.randint(0, count // 2))}  # some urls repeat
+        roll = rng.random()
+        if roll < 0.1:
+            site["error"] = "* Unable to connect to the site. *"  # no certificate
+        else:
+            if roll < 0.15:
+                site["expiry"] = float("nan")
+            elif roll < 0.3:
+                site["expiry"] = float(int(rng.choice(edges)) + rng.choice((-1, 0, 1)))  # on or either side of a boundary
+            else:
+                site["expiry"] = float(int(now + rng.uniform(-30, 400) * 86400))
+            if rng.random() < 0.8:
+                site["start"] = float("nan") if rng.random() < 0.1 else float(int(now - rng.uniform(0, 400) * 86400))
+            site.update({"name": rng.choice(("example.com", "*.example.com")), "issuer": rng.choice(("R3", "E1")),
+                         "number": str(rng.randint(1, 10 ** 6)), "countdown": "old countdown"})
+            if roll > 0.85:
+                site["error"] = rng.choice(("SSL Certificate error: hostname mismatch ",
+                                            "SOFT PASS: Domain has no valid SSL but a valid SSL was found on the "
+                                            "redirected domain: www.example.com"))
+        if rng.random() < 0.7:
+            site["checked"] = float("nan") if rng.random() < 0.1 else now - rng.uniform(0, 3600)
+        if rng.random() < 0.2:
+            site["cached"] = True
+        sites.append(site)
+    return sites
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_site_batch_matches_the_dictionary_implementation(monkeypatch, seed):
+    monkeypatch.setattr(conversions, "datetime", FixedDatetime)
+    sites = random_sites(seed, 2000)
+
+    expected = old_sorted_categories([without_nan_dates(site) for site in copy.deepcopy(sites)])
+    batch = SiteBatch.from_sites(sites)
+    batch.categorise(NOW)
+    categorised = batch.categories()
+
+    assert list(categorised) == list(expected)
+    for category in expected:
+        assert [dict(site) for site in categorised[category]] == expected[category], category
+    assert batch.rows(SITE_KEYS) == old_rows(expected, SITE_KEYS)
@@ -0,0 +1,104 @@
+import datetime
+import socket
+import ssl
+import tempfile
+import threading
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+import ssl_cert
+
+
+def write_certificate(directory, name, days):
+    """ a self signed certificate for localhost that expires in 'days' days. returns the (cert file, key file) """
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.utcnow()
+    certificate = (x509.CertificateBuilder().subject_name(subject).issuer_name(subject).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=days))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False)
+                   .sign(key, hashes.SHA256(), default_backend()))
+    cert_file, key_file = "{0}/{1}.crt".format(directory, name), "{0}/{1}.key".format(directory, name)
+    with open(cert_file, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return cert_file, key_file
+
+
+class RenewingServer:
+    """ a tls server on localhost whose certificate can be swapped between connections. the context (and its session
+    cache) is kept, as a server renewing its certificate would """
+
+    def __init__(self, cert_file, key_file):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.maximum_version = ssl.TLSVersion.TLSv1_2  # sessions resume without waiting for a ticket
+        self.context.load_cert_chain(cert_file, key_file)
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def renew(self, cert_file, key_file):
+        self.context.load_cert_chain(cert_file, key_file)
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            try:
+                with self.context.wrap_socket(sock, server_side=True) as ssock:
+                    ssock.recv(1)
+            except (OSError, ssl.SSLError):
+                pass
+
+
+def probe_expiry(port, capture):
+    result = ssl_cert.probe("localhost", port, 2, False, capture, [(socket.AF_INET, "127.0.0.1")])
+    return result.certificate.expiry_epoch
+
+
+def test_renewed_certificate_is_seen_on_the_next_probe():
+    with tempfile.TemporaryDirectory() as directory:
+        server = RenewingServer(*write_certificate(directory, "old", 10))
+        try:
+            for capture in (False, True):
+                server.renew(*write_certificate(directory, "old", 10))
+                old_expiry = probe_expiry(server.port, capture)
+                server.renew(*write_certificate(directory, "new", 90))
+                assert probe_expiry(server.port, capture) > old_expiry + 70 * 86400
+        finally:
+            server.listener.close()
+
+
+def test_failed_capture_handshake_reports_the_openssl_error():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def refuse():
+        sock, _ = listener.accept()
+        sock.recv(1024)
+        sock.sendall(b"\x15\x03\x03\x00\x02\x02\x28")  # fatal handshake_failure alert
+        sock.close()
+
+    thread = threading.Thread(target=refuse)
+    thread.daemon = True
+    thread.start()
+    try:
+        errors = []
+        der_cert, ssl_error = ssl_cert.capture_der_cert("localhost", listener.getsockname()[1], 2, errors,
+                                                        [(socket.AF_INET, "127.0.0.1")])
+    finally:
+        listener.close()
+    assert der_cert is None and ssl_error
+    assert errors and "handshake failure" in errors[0]